@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+benchmarks the hot paths of rename_images on a synthetic corpus of media files
+the results are printed as json so they can be compared across versions
+
+    $ python -m rename_images.bench --files 5000 --output bench.json
+"""
+import argparse
+import datetime
+import importlib.metadata
+import json
+import pathlib
+import platform
+import re
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+from . import rename_images
+
+DEFAULT_FIXTURES = pathlib.Path(__file__).parents[1].joinpath("tests", "images")
+VIDEO_DATE = datetime.datetime(2022, 2, 26, 20, 22, 13)  # UTC
+VIDEO_COORDINATES = b"+37.7749-122.4194/"
+
+
+def box(kind, payload, version=None):
+    """returns an ISO base media box, a full box if version is given"""
+    if version is not None:
+        payload = bytes([version, 0, 0, 0]) + payload
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def make_video(quicktime):
+    """
+    returns a minimal mp4 or mov file with the metadata read by the extractors
+    the moov box is placed after the media data, like most cameras do
+    """
+    creation_time = int((VIDEO_DATE - rename_images.MP4_EPOCH).total_seconds())
+    mvhd = box(
+        b"mvhd", struct.pack(">IIII", creation_time, 0, 600, 6000) + bytes(80), 0
+    )
+    udta = box(
+        b"udta",
+        box(
+            b"\xa9xyz",
+            struct.pack(">HH", len(VIDEO_COORDINATES), 0) + VIDEO_COORDINATES,
+        ),
+    )
+    key = rename_images.QUICKTIME_CREATIONDATE_KEY
+    keys = box(b"keys", struct.pack(">II4s", 1, 8 + len(key), b"mdta") + key, 0)
+    value = VIDEO_DATE.strftime("%Y-%m-%dT%H:%M:%S+0000").encode()
+    data = box(b"data", struct.pack(">II", rename_images.MP4_DATA_TYPE_UTF8, 0) + value)
+    ilst = box(b"ilst", box(struct.pack(">I", 1), data))
+    hdlr = box(b"hdlr", bytes(4) + b"mdta" + bytes(13), 0)
+    meta = box(b"meta", hdlr + keys + ilst, None if quicktime else 0)
+    ftyp = box(b"ftyp", b"qt  \x00\x00\x00\x00qt  " if quicktime else b"isom" * 3)
+    mdat = box(b"mdat", bytes(64 * 1024))
+    return ftyp + mdat + box(b"moov", mvhd + udta + meta)
+
+
+def load_fixtures(fixtures):
+    """returns { suffix: [contents of the fixtures] } including synthetic videos"""
+    contents = {}
+    for filepath in sorted(fixtures.rglob("*")):
+        suffix = filepath.suffix.lower()
+        if filepath.is_file() and suffix in rename_images.SUPPORTED_SUFFIXES:
+            contents.setdefault(suffix, []).append(filepath.read_bytes())
+    contents.setdefault(".mp4", []).append(make_video(quicktime=False))
+    contents.setdefault(".mov", []).append(make_video(quicktime=True))
+    return contents
+
+
+def make_corpus(directory, fixtures, files, files_per_directory, fanout):
+    """
+    fills the directory with copies of the fixtures spread over nested directories
+    every directory holds copies of a single fixture per type, so they share a
+    date of creation and collide when renamed. names match the default pattern
+    returns { suffix: [paths of the files created] }
+    """
+    contents = load_fixtures(fixtures)
+    suffixes = sorted(contents)
+    corpus = {suffix: [] for suffix in suffixes}
+    for i in range(files):
+        directory_index = i // files_per_directory
+        parts = []
+        while True:
+            parts.append(f"dir{directory_index % fanout:02d}")
+            directory_index //= fanout
+            if not directory_index:
+                break
+        parent = directory.joinpath(*reversed(parts))
+        parent.mkdir(parents=True, exist_ok=True)
+        suffix = suffixes[i % len(suffixes)]
+        variants = contents[suffix]
+        filepath = parent / f"IMG_{i % 10000:04d}{suffix}"
+        filepath.write_bytes(variants[(i // files_per_directory) % len(variants)])
+        corpus[suffix].append(filepath)
+    return corpus
+
+
+def summarize(durations):
+    """returns the statistics of the given durations in seconds"""
+    durations = sorted(durations)
+    total = sum(durations)
+    return {
+        "count": len(durations),
+        "total_s": total,
+        "mean_ms": statistics.fmean(durations) * 1000 if durations else None,
+        "median_ms": statistics.median(durations) * 1000 if durations else None,
+        "p95_ms": durations[int(len(durations) * 0.95)] * 1000 if durations else None,
+        "max_ms": durations[-1] * 1000 if durations else None,
+    }
+
+
+def time_calls(function, calls):
+    """calls the function with each of the given arguments, returns the durations"""
+    durations = []
+    for args in calls:
+        start = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def time_run(function, *args):
+    """returns the duration of a single call of the function"""
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def get_versions():
+    """returns the versions of this tool, python and the parsing libraries"""
+    versions = {"python": platform.python_version()}
+    for package in ("rename-images", "pillow", "piexif", "pyheif", "pymediainfo"):
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def run(directory, fixtures, files, files_per_directory, fanout, repeat):
+    """builds the corpus in the given directory and benchmarks it"""
+    corpus = make_corpus(directory, fixtures, files, files_per_directory, fanout)
+    extractors = {
+        ".jpg": rename_images.get_original_date_jpeg,
+        ".heic": rename_images.get_original_date_heif,
+        ".mp4": rename_images.get_original_date_mp4,
+        ".mov": rename_images.get_original_date_mov,
+    }
+    results = {}
+    for suffix, extractor in extractors.items():
+        calls = [(filepath,) for filepath in corpus.get(suffix, [])] * repeat
+        results[extractor.__name__] = summarize(time_calls(extractor, calls))
+
+    files = [filepath for paths in corpus.values() for filepath in paths]
+    names = {}
+    for filepath in files:
+        if filepath.parent not in names:
+            names[filepath.parent] = rename_images.list_names(filepath.parent)
+    date_created = datetime.datetime(2022, 2, 26, 20, 22, 13, 203000)
+    pattern = re.compile(rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE, re.IGNORECASE)
+    date_format = rename_images.DEFAULT_DATE_FORMAT
+    calls = [
+        (filepath, pattern, date_created, date_format, names[filepath.parent])
+        for filepath in files
+    ] * repeat
+    results["generate_new_filename"] = summarize(
+        time_calls(rename_images.generate_new_filename, calls)
+    )
+
+    durations = {
+        "process_path_dry_run": [],
+        "process_path_rename": [],
+        "revert_path": [],
+    }
+    for _ in range(repeat):
+        cache = rename_images.RevertCache(":memory:")
+        for dry_run, name in (
+            (True, "process_path_dry_run"),
+            (False, "process_path_rename"),
+        ):
+            durations[name].append(
+                time_run(
+                    rename_images.process_path,
+                    directory,
+                    True,  # recursive
+                    pattern,
+                    date_format,
+                    dry_run,
+                    cache,
+                    {},
+                )
+            )
+        # reverts the renames, restoring the corpus for the next repetition
+        durations["revert_path"].append(
+            time_run(rename_images.revert_path, directory, True, False, cache)
+        )
+        cache.close()
+    for name, values in durations.items():
+        results[name] = summarize(values)
+        results[name]["files_per_second"] = len(values) * len(files) / sum(values)
+
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "versions": get_versions(),
+        "corpus": {
+            "files": len(files),
+            "files_per_directory": files_per_directory,
+            "fanout": fanout,
+            "repeat": repeat,
+            "types": {suffix: len(paths) for suffix, paths in corpus.items()},
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    """builds a synthetic corpus in a temporary directory and benchmarks it"""
+    parser = argparse.ArgumentParser(
+        description="benchmarks rename_images on a synthetic corpus of media files",
+    )
+    parser.add_argument(
+        "-n", "--files", default=1000, type=int, help="number of files to generate"
+    )
+    parser.add_argument(
+        "--files-per-directory",
+        default=40,
+        type=int,
+        help="files per directory, files of the same type in a directory collide",
+    )
+    parser.add_argument(
+        "--fanout", default=8, type=int, help="subdirectories per directory"
+    )
+    parser.add_argument(
+        "--repeat", default=1, type=int, help="number of times to run each benchmark"
+    )
+    parser.add_argument(
+        "--fixtures",
+        default=DEFAULT_FIXTURES,
+        type=pathlib.Path,
+        help="directory of sample media files the corpus is generated from",
+    )
+    parser.add_argument(
+        "--directory",
+        type=pathlib.Path,
+        help="where to generate the corpus, a temporary directory by default",
+    )
+    parser.add_argument(
+        "-o", "--output", type=pathlib.Path, help="writes the results to this file"
+    )
+    args = parser.parse_args(argv)
+
+    directory = args.directory or pathlib.Path(tempfile.mkdtemp(prefix="rename_images"))
+    try:
+        results = run(
+            directory.joinpath("corpus"),
+            args.fixtures,
+            args.files,
+            args.files_per_directory,
+            args.fanout,
+            args.repeat,
+        )
+    finally:
+        shutil.rmtree(directory.joinpath("corpus"), ignore_errors=True)
+        if not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        args.output.write_text(output, encoding="utf-8")
+    else:
+        sys.stdout.write(output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
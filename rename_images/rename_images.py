@@ -4,277 +4,3119 @@
 this script renames images according to the time they were taken
 """
 import argparse
+import collections
+import contextlib
+import cProfile
 import datetime
+import fnmatch
+import functools
+import itertools
 import json
 import logging
+import operator
 import os
 import pathlib
 import re
+import select
+import signal
+import sqlite3
+import struct
 import sys
+import threading
+import time
 from zoneinfo import ZoneInfo
 
-import piexif  # parses exif metadata
-import pyheif  # parses heif images
-import pymediainfo  # parses videos
-from timezonefinder import TimezoneFinder
-from PIL import Image, UnidentifiedImageError  # requires pillow package - parses images
+# the parsing libraries are slow to import, they're imported on first use so a
+# run only pays for the ones it needs. see import_mediainfo()
+# - piexif: parses exif metadata
+# - pyheif: parses heif images
+# - timezonefinder: finds the timezone of the coordinates of videos
+# - PIL: requires pillow package - parses images
+# - pymediainfo: parses malformed videos, optional since videos are parsed natively
 
-CACHE_FILENAME = "rename_images.json"
+CACHE_FILENAME = "rename_images.sqlite3"
+LEGACY_CACHE_FILENAME = "rename_images.json"
+CACHE_COMMIT_INTERVAL = 100  # changes recorded before they are flushed to disk
+METADATA_CACHE_FILENAME = "rename_images_metadata.sqlite3"
+METADATA_CACHE_VERSION = 1  # bump when the extractors change, discards cached dates
 TAG_DATETIME_ORIGINAL = 36867  # exif:DateTimeOriginal
 TAG_DATETIME_DIGITIZED = 36868  # exif:DateTimeDigitized
 TAG_SUBSECTIME_ORIGINAL = 37521  # exif:SubSecTimeOriginal
+TAG_EXIF_IFD_POINTER = 34665  # exif:ExifIfdPointer
+TAG_MODEL = 272  # exif:Model
+TIFF_POINTER_TAGS = {TAG_EXIF_IFD_POINTER}  # tags holding the offset of an IFD
+TIFF_TYPE_ASCII = 2
+TIFF_TYPE_LONG = 4
+TIFF_TYPE_IFD = 13  # offset of an IFD, used instead of LONG by some raw files
+TIFF_MAX_IFD_ENTRIES = 1024  # more entries than this means the data is corrupt
+TIFF_MAX_ASCII_LENGTH = 64  # the date tags we read are at most 20 bytes long
+JPEG_SOI = b"\xff\xd8"  # start of image
+JPEG_SOS = 0xDA  # start of scan, no more metadata segments after it
+JPEG_EOI = 0xD9  # end of image
+JPEG_APP1 = 0xE1
+EXIF_HEADER = b"Exif\x00\x00"
+ISOBMFF_MAX_BOX_READ = 1 << 20  # boxes read into memory (iinf, iloc) are small
+MP4_EPOCH = datetime.datetime(1904, 1, 1)  # mvhd times are seconds since 1904 in UTC
+MP4_DATA_TYPE_UTF8 = 1
+QUICKTIME_CREATIONDATE_KEY = b"com.apple.quicktime.creationdate"
+HEIF_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx", b"mif1", b"msf1"}
+QUICKTIME_BRAND = b"qt  "
+# major brands of the mp4 files, other ISO base media files (avif, cr3, 3gp, m4a)
+# aren't parsed by the mp4 extractor
+MP4_BRANDS = {
+    b"isom",
+    b"iso2",
+    b"iso3",
+    b"iso4",
+    b"iso5",
+    b"iso6",
+    b"mp41",
+    b"mp42",
+    b"avc1",
+    b"dash",
+    b"mmp4",
+    b"M4V ",
+    b"M4VH",
+    b"M4VP",
+    b"MSNV",
+    b"NDAS",
+    b"XAVC",
+    b"f4v ",
+}
+QUICKTIME_BOXES = {b"moov", b"mdat", b"wide", b"free", b"skip"}  # files without ftyp
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_CREATION_TIME = b"Creation Time"  # tEXt keyword, see the png specification
+PNG_MAX_TEXT_LENGTH = 1024  # longer tEXt chunks don't hold a date
+WEBP_VP8X_EXIF = 0x08  # flag of the VP8X chunk telling there's an EXIF chunk
+SNIFF_SIZE = 16  # bytes read to recognize the type of a file, see sniff_extractor()
+READ_WINDOW = 16 * 1024  # bytes read at once at the start of a file, see MediaReader
+READ_BLOCK = 8 * 1024  # bytes read at once elsewhere in a file, see MediaReader
+EXTRACTORS_ENTRY_POINT_GROUP = "rename_images.extractors"
+EXIFTOOL_COMMAND = "exiftool"
+DEFAULT_EXIFTOOL_BATCH_SIZE = 64  # files sent to exiftool at a time
+EXIFTOOL_TIMEOUT = 5  # seconds exiftool is given to exit
+EXIFTOOL_ARGS = (
+    "-json",
+    "-fast",
+    "-charset",
+    "filename=utf8",
+    "-SubSecDateTimeOriginal",
+    "-DateTimeOriginal",
+    "-SubSecTimeOriginal",
+    "-CreationDate",
+    "-CreateDate",
+)
+# tags holding the date of creation, by priority. see parse_exiftool_entry()
+EXIFTOOL_DATE_TAGS = (
+    "SubSecDateTimeOriginal",
+    "DateTimeOriginal",
+    "CreationDate",
+    "CreateDate",
+)
+# formats read by exiftool but not by the native extractors
+EXIFTOOL_SUFFIXES = {
+    ".3gp",
+    ".avi",
+    ".avif",
+    ".cr3",
+    ".gif",
+    ".heif",
+    ".m4v",
+    ".mts",
+    ".orf",
+    ".raf",
+    ".rw2",
+    ".tif",
+    ".tiff",
+}
 DEFAULT_PATTERN_NAME_TO_REPLACE = r"^(IMG_\d{4}|(PXL_)?\d{8}_\d{6}(\d{3})?|ABP_\d{4}|DSC\d{5}|DSCN\d{4}|\d{3}_\d{4})(\(\d\))?"
 DEFAULT_DATE_FORMAT = "%Y%m%d_%H%M%S%f"
+SUPPORTED_SUFFIXES = set()  # filled by register_extractor()
+TEMPORARY_NAME = ".{}.rename_images"  # used to break cycles of renames
+JOBS_CHUNKSIZE = 64  # files handed to a worker at a time when using --jobs
+DEFAULT_TIMEZONE_PRECISION = 3  # decimal places of the coordinates, about 100m
+TIMEZONE_CACHE_SIZE = 4096
+TEMPLATE_CACHE_SIZE = 32  # compiled date formats and rename templates
+DEFAULT_MAX_INFLIGHT = 32  # blocking operations running at once in rename_tree()
+DEFAULT_REVERT_THREADS = 8  # directories reverted at once, see revert_directory()
+DEFAULT_WATCH_SETTLE = 2.0  # seconds a file must stay unchanged before it's renamed
+DEFAULT_POLL_INTERVAL = 2.0  # seconds between listings when inotify isn't available
+WATCH_TIMEOUT = 1.0  # seconds between checks of the stop event of watch()
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_BUFFER_SIZE = 64 * 1024
+# patterns of the datetime.strftime() directives, see compile_date_format()
+DATE_DIRECTIVE_PATTERNS = {
+    "%Y": r"\d{4}",
+    "%G": r"\d{4}",
+    "%y": r"\d{2}",
+    "%m": r"\d{2}",
+    "%d": r"\d{2}",
+    "%H": r"\d{2}",
+    "%I": r"\d{2}",
+    "%M": r"\d{2}",
+    "%S": r"\d{2}",
+    "%U": r"\d{2}",
+    "%W": r"\d{2}",
+    "%V": r"\d{2}",
+    "%j": r"\d{3}",
+    "%f": r"\d{6}",
+    "%L": r"\d{3}",  # milliseconds, see date_to_string()
+    "%u": r"\d",
+    "%w": r"\d",
+    "%a": r"[a-z]+",
+    "%A": r"[a-z]+",
+    "%b": r"[a-z]+",
+    "%B": r"[a-z]+",
+    "%p": r"[a-z]+",
+    "%z": r"([+-]\d{4})?",
+    "%%": "%",
+    # placeholders of the rename template, see RenameTemplate
+    "{seq}": r"\d{3,}",
+    "{camera}": r".*?",
+    "{orig}": r".*?",
+}
+# datetime attributes and printf-style formats of the directives formatted
+# without strftime(), see compile_date_formatter()
+DATE_DIRECTIVE_FIELDS = {
+    "%Y": ("year", "%04d"),
+    "%m": ("month", "%02d"),
+    "%d": ("day", "%02d"),
+    "%H": ("hour", "%02d"),
+    "%M": ("minute", "%02d"),
+    "%S": ("second", "%02d"),
+    "%f": ("microsecond", "%06d"),
+    "%L": ("microsecond", "%03d"),  # milliseconds
+}
+TEMPLATE_PLACEHOLDER = re.compile(r"\{(camera|orig|seq)\}")
 LEGAL_DATE_FORMAT_CHARS = re.compile(
-    r"((%[a-z])*[\w\- ]*)*([\w\- ]*(%[a-z])*)*", flags=re.ASCII | re.IGNORECASE
+    r"((%[a-z]|\{(camera|orig|seq)\})*[\w\- ]*)*([\w\- ]*(%[a-z])*)*",
+    flags=re.ASCII | re.IGNORECASE,
 )
 
-logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
+
+# settings of the timezone lookups, see configure_timezone_lookup()
+TIMEZONE_LOOKUP = {"precision": DEFAULT_TIMEZONE_PRECISION, "in_memory": False}
+ENGINE = {"exiftool": None}  # see configure_exiftool()
+MEDIA_READER = {"max_bytes": None, "drop_cache": False}  # see configure_media_reader()
+SHARED_MEDIA = (
+    threading.local()
+)  # file open for the parsers of a thread, see share_media()
+TIMEZONE_LOCK = threading.Lock()  # TimezoneFinder isn't safe to share across threads
+
+
+class Stats:
+    """
+    durations of the stages of a run and counters such as the bytes read
+    nothing is collected unless enabled, see --stats
+    safe to share across threads, the files are parsed by thread pools
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.durations = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """discards what was collected so far"""
+        self.durations = {}
+        self.counters = {}
+
+    def time(self, stage):
+        """returns a context manager recording the duration of its block"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return StageTimer(self, stage)
+
+    def record(self, stage, duration):
+        """records the duration in seconds of a stage"""
+        with self.lock:
+            self.durations.setdefault(stage, []).append(duration)
+
+    def count(self, counter, value=1):
+        """increments the given counter"""
+        if self.enabled:
+            with self.lock:
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def merge(self, durations, counters):
+        """adds the stats collected elsewhere, such as in a worker process"""
+        with self.lock:
+            for stage, values in durations.items():
+                self.durations.setdefault(stage, []).extend(values)
+            for counter, value in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def report(self, elapsed):
+        """returns the collected stats, elapsed is the duration of the run in seconds"""
+        stages = {}
+        for stage, values in self.durations.items():
+            values = sorted(values)
+            stages[stage] = {"count": len(values), "total_s": sum(values)}
+            for percentile in (50, 95, 99):
+                index = min(len(values) - 1, len(values) * percentile // 100)
+                stages[stage][f"p{percentile}_ms"] = values[index] * 1000
+        files = self.counters.get("files", 0)
+        return {
+            "elapsed_s": elapsed,
+            "files": files,
+            "files_per_second": files / elapsed if elapsed else None,
+            "counters": dict(self.counters),
+            "stages": stages,
+        }
+
+
+class StageTimer:
+    """context manager recording the duration of its block into Stats"""
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.stage, time.perf_counter() - self.start)
+
+
+STATS = Stats()
+
+
+def timed(stage):
+    """decorator recording the duration of each call of the function, see Stats"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with STATS.time(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def format_stats(report):
+    """returns the stats report as a table"""
+    lines = [
+        f"{'stage':<24}{'count':>10}{'total_s':>12}{'p50_ms':>10}{'p95_ms':>10}{'p99_ms':>10}"
+    ]
+    for stage, values in sorted(report["stages"].items()):
+        lines.append(
+            f"{stage:<24}{values['count']:>10}{values['total_s']:>12.3f}"
+            f"{values['p50_ms']:>10.3f}{values['p95_ms']:>10.3f}{values['p99_ms']:>10.3f}"
+        )
+    bytes_read = report["counters"].get("bytes_read", 0)
+    lines.append(
+        f"{report['files']} files in {report['elapsed_s']:.3f}s"
+        f" ({report['files_per_second'] or 0:.1f} files/s),"
+        f" {bytes_read / 1024 / 1024:.1f} MiB read by the native parsers"
+    )
+    if (
+        "files_skipped" in report["counters"]
+        or "directories_skipped" in report["counters"]
+    ):
+        lines.append(
+            f"{report['counters'].get('files_skipped', 0)} files already renamed and"
+            f" {report['counters'].get('directories_skipped', 0)} unchanged directories skipped"
+        )
+    return "\n".join(lines) + "\n"
+
+
+class ReadBudgetExceeded(Exception):
+    """raised when parsing a file would read more than its budget, see MediaReader"""
+
+
+class MediaReader:
+    """
+    read-only file object used by the native parsers, reading the file with pread
+    the first window bytes are read at once and served as memoryview slices,
+    without copying. other parts of the file, such as the metadata at the end of
+    videos, are read on demand by blocks. read-ahead is disabled so only the
+    parsed parts of large files are read
+    max_bytes: budget of bytes read from the file, ReadBudgetExceeded is raised
+               by the read exceeding it. None for unlimited. the window is
+               limited to half of it, leaving room for the end of the file
+    drop_cache: drops the pages of the file from the page cache once closed, so
+                scanning an archive doesn't evict the data other programs use
+    """
+
+    def __init__(self, filepath, max_bytes=None, window=READ_WINDOW, drop_cache=False):
+        self.fd = os.open(filepath, os.O_RDONLY)
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.position = 0
+        self.block = memoryview(b"")
+        self.block_offset = 0
+        self.drop_cache = drop_cache and hasattr(os, "posix_fadvise")
+        try:
+            self.size = os.fstat(self.fd).st_size
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_RANDOM)
+            if max_bytes is not None:
+                window = min(window, max_bytes // 2)
+            self.window = memoryview(self.pread(min(window, self.size), 0))
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def pread(self, size, offset):
+        """reads size bytes at the given offset, within the budget"""
+        self.bytes_read += size
+        STATS.count("bytes_read", size)
+        if self.max_bytes is not None and self.bytes_read > self.max_bytes:
+            raise ReadBudgetExceeded(
+                f"more than {self.max_bytes} bytes would be read from the file"
+            )
+        return os.pread(self.fd, size, offset)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """moves to the given position, see io.IOBase.seek()"""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return offset
+
+    def tell(self):
+        """returns the current position"""
+        return self.position
+
+    def view(self, size=-1):
+        """returns a memoryview of the next size bytes, all the rest if negative"""
+        start = self.position
+        end = self.size if size < 0 else min(start + size, self.size)
+        if end <= start:
+            return memoryview(b"")
+        self.position = end
+        if end <= len(self.window):
+            return self.window[start:end]
+        offset = self.block_offset
+        if offset <= start and end <= offset + len(self.block):
+            return self.block[start - offset : end - offset]
+        size = max(end - start, READ_BLOCK)
+        if self.max_bytes is not None:
+            size = max(end - start, min(size, self.max_bytes - self.bytes_read))
+        self.block = memoryview(self.pread(min(size, self.size - start), start))
+        self.block_offset = start
+        return self.block[: end - start]
+
+    def read(self, size=-1):
+        """returns the next size bytes, all the rest if negative"""
+        return self.view(size).tobytes()
+
+    def close(self):
+        """closes the file, dropping the pages read from the page cache"""
+        if self.fd < 0:
+            return
+        if self.drop_cache:
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(self.fd)
+        self.fd = -1
+
+
+def configure_media_reader(max_bytes, drop_cache=False):
+    """
+    sets the budget of bytes the native parsers read from each file, None for
+    unlimited, and whether the files are dropped from the page cache once parsed.
+    the libraries the parsers fall back to for malformed files can't be bounded,
+    so they aren't used with a budget. see MediaReader
+    """
+    MEDIA_READER["max_bytes"] = max_bytes
+    MEDIA_READER["drop_cache"] = drop_cache
+
+
+def is_read_budget_set(filepath):
+    """returns whether a read budget is set, logging that the file can't be parsed by a library"""
+    if MEDIA_READER["max_bytes"] is None:
+        return False
+    logger.debug("unable to parse '%s' within the read budget", filepath)
+    return True
+
+
+def open_media(filepath):
+    """
+    opens the file for the native parsers, see MediaReader
+    returns the reader shared by share_media() if the file is open already
+    """
+    if getattr(SHARED_MEDIA, "filepath", None) == filepath:
+        SHARED_MEDIA.reader.seek(0)
+        return contextlib.nullcontext(SHARED_MEDIA.reader)
+    return MediaReader(
+        filepath, MEDIA_READER["max_bytes"], drop_cache=MEDIA_READER["drop_cache"]
+    )
+
+
+@contextlib.contextmanager
+def share_media(filepath):
+    """
+    opens the file once for all the parsers reading it within the block, such as
+    the sniffer and the extractor. each open is a round trip on network mounts
+    if the file can't be opened, the parsers open it themselves and report it
+    """
+    try:
+        reader = open_media(filepath)
+    except OSError:
+        yield
+        return
+    previous = getattr(SHARED_MEDIA, "filepath", None), getattr(
+        SHARED_MEDIA, "reader", None
+    )
+    SHARED_MEDIA.filepath, SHARED_MEDIA.reader = filepath, reader
+    try:
+        with reader:
+            yield
+    finally:
+        SHARED_MEDIA.filepath, SHARED_MEDIA.reader = previous
+
+
+def date_to_string(date, date_format):
+    """converts a date to string. sample output: 20210620_141545333"""
+    result = date.strftime(date_format)
+    if date_format == DEFAULT_DATE_FORMAT:
+        result = result[:-3]
+    return result
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_date_formatter(date_format):
+    """
+    returns a function formatting dates like datetime.strftime(), %L standing for
+    milliseconds. the directives of DATE_DIRECTIVE_FIELDS are formatted from the
+    attributes of the date in a single printf-style operation, formats holding
+    other directives fall back to strftime() for each of them
+    """
+    parts = re.split(r"(%.)", date_format)
+    directives = parts[1::2]
+    if not all(
+        directive in DATE_DIRECTIVE_FIELDS or directive == "%%"
+        for directive in directives
+    ):
+
+        def format_date(date):
+            return "".join(
+                part
+                if i % 2 == 0
+                else f"{date.microsecond // 1000:03d}"
+                if part == "%L"
+                else date.strftime(part)
+                for i, part in enumerate(parts)
+            )
+
+        return format_date
+
+    template = "".join(
+        DATE_DIRECTIVE_FIELDS[part][1]
+        if i % 2 and part != "%%"
+        else part.replace("%", "%%")
+        for i, part in enumerate(parts)
+    )
+    directives = [directive for directive in directives if directive != "%%"]
+    attributes = [DATE_DIRECTIVE_FIELDS[directive][0] for directive in directives]
+    milliseconds = [i for i, directive in enumerate(directives) if directive == "%L"]
+    if len(attributes) > 1:
+        get_values = operator.attrgetter(*attributes)
+    else:
+
+        def get_values(date):
+            return tuple(getattr(date, attribute) for attribute in attributes)
+
+    def format_date(date):
+        values = get_values(date)
+        if milliseconds:
+            values = list(values)
+            for i in milliseconds:
+                values[i] //= 1000
+            values = tuple(values)
+        return template % values
+
+    return format_date
+
+
+def compile_date_format(date_format):
+    """
+    returns a regex matching names that start with a date in the given format
+    the date is in the form given by date_to_string(), the placeholders of the
+    rename template match any text, see RenameTemplate
+    """
+    parts = re.split(r"(%.|\{(?:camera|orig|seq)\})", date_format)
+    if date_format == DEFAULT_DATE_FORMAT:
+        # date_to_string() truncates the microseconds to milliseconds
+        parts[-2] = "%L"
+    regex = []
+    for part in parts:
+        if part in DATE_DIRECTIVE_PATTERNS:
+            regex.append(DATE_DIRECTIVE_PATTERNS[part])
+        elif part.startswith("%"):
+            regex.append(r".+?")
+        else:
+            regex.append(re.escape(part))
+    return re.compile("".join(regex), flags=re.IGNORECASE)
+
+
+def parse_jpeg_date(date_str):
+    """converts string to date"""
+    try:
+        return datetime.datetime.fromisoformat(date_str.replace(":", "-", 2))
+    except ValueError as e:
+        logger.debug(e)
+    return None
+
+
+def parse_png_date(date_str):
+    """
+    converts string to date, either an exif date or the Creation Time of a png
+    which is usually in the ISO 8601 or RFC 1123 format
+    """
+    import email.utils
+
+    try:
+        return datetime.datetime.fromisoformat(date_str)
+    except ValueError:
+        pass
+    try:
+        return email.utils.parsedate_to_datetime(date_str)
+    except (TypeError, ValueError):
+        pass
+    return parse_jpeg_date(date_str)
+
+
+def parse_mov_date(date_str):
+    """converts string to date"""
+    try:
+        return datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S%z")
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def configure_timezone_lookup(precision=DEFAULT_TIMEZONE_PRECISION, in_memory=False):
+    """
+    precision: decimal places the coordinates are rounded to before looking up
+               their timezone. lookups of the same rounded coordinates are cached
+    in_memory: loads the timezone polygons into memory, faster for many lookups
+    """
+    TIMEZONE_LOOKUP["precision"] = precision
+    TIMEZONE_LOOKUP["in_memory"] = in_memory
+    get_timezone_finder.cache_clear()
+    lookup_timezone.cache_clear()
+
+
+@functools.cache
+def get_timezone_finder():
+    """returns the TimezoneFinder of this process, created on first use"""
+    from timezonefinder import TimezoneFinder
+
+    return TimezoneFinder(in_memory=TIMEZONE_LOOKUP["in_memory"])
+
+
+@functools.lru_cache(maxsize=TIMEZONE_CACHE_SIZE)
+def lookup_timezone(latitude, longitude):
+    """returns the name of the timezone at the given coordinates"""
+    with TIMEZONE_LOCK:
+        return get_timezone_finder().timezone_at(lng=longitude, lat=latitude)
+
+
+@timed("timezone")
+def timezone_at(latitude, longitude):
+    """
+    returns the name of the timezone at the given coordinates, None if not found
+    the coordinates are rounded, see configure_timezone_lookup()
+    """
+    precision = TIMEZONE_LOOKUP["precision"]
+    return lookup_timezone(round(latitude, precision), round(longitude, precision))
+
+
+def parse_mp4_date(date_str, coordinates, duration):
+    """
+    duration: used to subtract from the date to find out the beginning of the video
+    coordinates: used to findout the timezone and apply the timezone to the date
+    """
+    try:
+        result = datetime.datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S %Z")
+        if duration:
+            result = result - datetime.timedelta(milliseconds=duration)
+        if coordinates:
+            # https://stackoverflow.com/questions/3518504/regular-expression-for-matching-latitude-longitude-coordinates#comment127711918_18690202
+            m = re.match(
+                r"(?P<lat>^[-+]?(?:[1-8]?\d(?:\.\d+)?|90(?:\.0+)?))(?P<lng>[-+]?(?:180(?:\.0+)?|(?:1[0-7]\d|[1-9]?\d)(?:\.\d+)?))/?$",
+                coordinates,
+            )
+            if m:
+                longitude = float(m.group("lng"))
+                latitude = float(m.group("lat"))
+                tz = timezone_at(latitude, longitude)
+                if tz:
+                    tz = ZoneInfo(tz)
+                    result = result.astimezone(tz)
+                    result = tz.fromutc(result)
+                    return result
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def read_tiff_ifd(fp, base, byte_order, offset, tags):
+    """
+    reads the image file directory (IFD) at the given offset of a TIFF structure
+    returns a dictionary with the values of the given tags that were found
+    the values of pointer tags, of type LONG or IFD, are returned as int and the
+    values of the other tags, of type ASCII, as bytes. other types are ignored
+    """
+    fp.seek(base + offset)
+    (count,) = struct.unpack(byte_order + "H", fp.read(2))
+    if count > TIFF_MAX_IFD_ENTRIES:
+        raise ValueError(f"too many IFD entries: {count}")
+    entries = getattr(fp, "view", fp.read)(count * 12)
+    values = {}
+    for i in range(count):
+        tag, kind, length, value = struct.unpack_from(
+            byte_order + "HHI4s", entries, i * 12
+        )
+        if tag not in tags:
+            continue
+        if tag in TIFF_POINTER_TAGS:
+            if kind in (TIFF_TYPE_LONG, TIFF_TYPE_IFD):
+                (values[tag],) = struct.unpack(byte_order + "I", value)
+        elif kind == TIFF_TYPE_ASCII and length <= TIFF_MAX_ASCII_LENGTH:
+            if length > 4:
+                (value_offset,) = struct.unpack(byte_order + "I", value)
+                fp.seek(base + value_offset)
+                value = fp.read(length)
+            values[tag] = value[:length].split(b"\x00", 1)[0]
+    return values
+
+
+def read_tiff_header(fp, base):
+    """
+    reads the header of the TIFF structure starting at the given position
+    returns (byte_order, ifd_offset) where byte_order is a struct prefix
+    """
+    fp.seek(base)
+    header = fp.read(8)
+    if header[:2] == b"II":
+        byte_order = "<"
+    elif header[:2] == b"MM":
+        byte_order = ">"
+    else:
+        raise ValueError("invalid TIFF byte order")
+    magic, ifd_offset = struct.unpack(byte_order + "HI", header[2:8])
+    if magic != 42:
+        raise ValueError("invalid TIFF header")
+    return byte_order, ifd_offset
+
+
+def read_exif_date(fp, base):
+    """
+    reads the DateTimeOriginal/DateTimeDigitized and SubSecTimeOriginal tags of
+    the exif TIFF structure starting at the given position of the file
+    only the IFDs holding these tags are read, thumbnails and maker notes are skipped
+    returns a string such as '2022:02:26 20:22:13.203' or None if not found
+    raises ValueError or struct.error if the data is malformed
+    """
+    byte_order, ifd_offset = read_tiff_header(fp, base)
+    date_tags = {
+        TAG_DATETIME_ORIGINAL,
+        TAG_DATETIME_DIGITIZED,
+        TAG_SUBSECTIME_ORIGINAL,
+    }
+    values = read_tiff_ifd(
+        fp, base, byte_order, ifd_offset, date_tags | {TAG_EXIF_IFD_POINTER}
+    )
+    exif_ifd_offset = values.pop(TAG_EXIF_IFD_POINTER, None)
+    if exif_ifd_offset:
+        values.update(read_tiff_ifd(fp, base, byte_order, exif_ifd_offset, date_tags))
+
+    date_created = values.get(TAG_DATETIME_ORIGINAL) or values.get(
+        TAG_DATETIME_DIGITIZED
+    )
+    if not date_created:
+        return None
+    subsec = values.get(TAG_SUBSECTIME_ORIGINAL, b"")
+    return (date_created + b"." + subsec.zfill(3)).decode("latin-1")
+
+
+def read_exif_model(fp, base):
+    """
+    reads the Model tag of the exif TIFF structure starting at the given position
+    of the file, see read_exif_date(). returns None if not found
+    """
+    byte_order, ifd_offset = read_tiff_header(fp, base)
+    values = read_tiff_ifd(fp, base, byte_order, ifd_offset, {TAG_MODEL})
+    return str(values[TAG_MODEL], "latin-1").strip() if TAG_MODEL in values else None
+
+
+def read_jpeg_exif_date(fp, read=read_exif_date):
+    """
+    walks the segments at the start of the jpeg file until the exif APP1 segment
+    is found and reads the date of creation from it. see read_exif_date()
+    read: function reading the exif TIFF structure, such as read_exif_model()
+    """
+    if fp.read(2) != JPEG_SOI:
+        raise ValueError("not a jpeg file")
+    while True:
+        header = fp.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            raise ValueError("invalid jpeg segment")
+        marker = header[1]
+        if marker in (JPEG_SOS, JPEG_EOI):
+            return None
+        (length,) = struct.unpack(">H", header[2:])
+        if length < 2:
+            raise ValueError("invalid jpeg segment length")
+        start = fp.tell()
+        if marker == JPEG_APP1 and fp.read(6) == EXIF_HEADER:
+            return read(fp, start + 6)
+        fp.seek(start + length - 2)
+
+
+def read_pillow_exif_date(filepath):
+    """
+    reads the date of creation of the image using pillow
+    slower than read_jpeg_exif_date() but more tolerant of malformed files
+    """
+    if is_read_budget_set(filepath):
+        return None
+    from PIL import Image
+
+    try:
+        with Image.open(filepath) as image:
+            # NOTE: using old "private" method because new public method
+            #       doesn't include this tag. It does include 306 "DateTime"
+            #       though, but "DateTime" might differ from "DateTimeOriginal"
+            # pylint: disable-next=protected-access
+            exif = image._getexif()
+            date_created = exif.get(TAG_DATETIME_ORIGINAL)
+            if not date_created:
+                date_created = exif.get(TAG_DATETIME_DIGITIZED)
+            if date_created:
+                date_created += "." + exif.get(TAG_SUBSECTIME_ORIGINAL, "").zfill(3)
+    except (OSError, AttributeError):  # UnidentifiedImageError, truncated data
+        logger.debug("unable to parse '%s'", filepath)
+        return None
+    return date_created
+
+
+@timed("extract_jpeg")
+def get_original_date_jpeg(filepath):
+    """
+    returns the DateTimeOriginal/DateTimeDigitized exif data from the given jpeg file
+    only the exif segment is read. falls back to pillow for malformed files
+    """
+    try:
+        with open_media(filepath) as fp:
+            date_created = read_jpeg_exif_date(fp)
+    except (ValueError, struct.error):
+        logger.debug("falling back to pillow to parse '%s'", filepath)
+        date_created = read_pillow_exif_date(filepath)
+
+    if date_created:
+        date_created = parse_jpeg_date(date_created)
+
+    return date_created
+
+
+def iter_boxes(fp, start, end=None):
+    """
+    yields (type, payload_start, payload_end) for each box of an ISO base media
+    file (heif, mp4, mov) found between the given positions of the file
+    only the box headers are read, end=None means until the end of the file
+    """
+    offset = start
+    while end is None or offset + 8 <= end:
+        fp.seek(offset)
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", fp.read(8))
+            header_size = 16
+        elif size == 0:  # the box extends to the end of the file
+            if end is None:
+                end = fp.seek(0, os.SEEK_END)
+            size = end - offset
+        if size < header_size:
+            raise ValueError(f"invalid size of box '{kind}'")
+        yield kind, offset + header_size, offset + size
+        offset += size
+
+
+def find_box(fp, kind, start, end=None):
+    """returns (payload_start, payload_end) of the first box of the given type"""
+    for box_kind, payload_start, payload_end in iter_boxes(fp, start, end):
+        if box_kind == kind:
+            return payload_start, payload_end
+    return None
+
+
+def read_box(fp, payload_start, payload_end):
+    """
+    returns the payload of a box, a memoryview of the file if it's a MediaReader
+    """
+    if payload_end - payload_start > ISOBMFF_MAX_BOX_READ:
+        raise ValueError("box too large")
+    fp.seek(payload_start)
+    read = getattr(fp, "view", fp.read)
+    return read(payload_end - payload_start)
+
+
+def read_uint(data, pos, size):
+    """reads a big endian unsigned integer of the given size in bytes"""
+    if pos + size > len(data):
+        raise ValueError("unexpected end of box")
+    return int.from_bytes(data[pos : pos + size], "big"), pos + size
+
+
+def find_heif_item_id(iinf, item_type):
+    """returns the id of the first item of the given type in the iinf box payload"""
+    version = iinf[0]
+    pos = 6 if version == 0 else 8  # version, flags and entry_count
+    while pos + 8 <= len(iinf):
+        size, kind = struct.unpack_from(">I4s", iinf, pos)
+        if size < 8:
+            raise ValueError("invalid size of box 'infe'")
+        # infe: version(1) flags(3) item_ID(2 or 4) item_protection_index(2) item_type(4)
+        if kind == b"infe" and iinf[pos + 8] in (2, 3):
+            id_size = 2 if iinf[pos + 8] == 2 else 4
+            item_id, item_pos = read_uint(iinf, pos + 12, id_size)
+            if iinf[item_pos + 2 : item_pos + 6] == item_type:
+                return item_id
+        pos += size
+    return None
+
+
+def find_heif_item_offset(iloc, item_id):
+    """returns the file offset of the data of the given item in the iloc box payload"""
+    version = iloc[0]
+    offset_size, length_size = iloc[4] >> 4, iloc[4] & 0x0F
+    base_offset_size, index_size = iloc[5] >> 4, iloc[5] & 0x0F
+    if version < 1:
+        index_size = 0
+    id_size = 2 if version < 2 else 4
+    item_count, pos = read_uint(iloc, 6, id_size)
+    for _ in range(item_count):
+        current_id, pos = read_uint(iloc, pos, id_size)
+        construction_method = 0
+        if version in (1, 2):
+            construction_method, pos = read_uint(iloc, pos, 2)
+            construction_method &= 0x0F
+        pos += 2  # data_reference_index
+        base_offset, pos = read_uint(iloc, pos, base_offset_size)
+        extent_count, pos = read_uint(iloc, pos, 2)
+        extent_offset = None
+        for i in range(extent_count):
+            pos += index_size
+            offset, pos = read_uint(iloc, pos, offset_size)
+            pos += length_size
+            if i == 0:
+                extent_offset = offset
+        if current_id == item_id:
+            if construction_method != 0 or extent_offset is None:
+                raise ValueError("unsupported item construction method")
+            return base_offset + extent_offset
+    return None
+
+
+def read_heif_exif_date(fp, read=read_exif_date):
+    """
+    locates the exif item of the heif file through the meta/iinf and meta/iloc
+    boxes and reads the date of creation from it. see read_exif_date()
+    the image data is never read nor decoded
+    read: function reading the exif TIFF structure, such as read_exif_model()
+    """
+    meta = find_box(fp, b"meta", 0)
+    if not meta:
+        raise ValueError("meta box not found")
+    meta_start = meta[0] + 4  # meta is a full box: version and flags
+    iinf = find_box(fp, b"iinf", meta_start, meta[1])
+    iloc = find_box(fp, b"iloc", meta_start, meta[1])
+    if not iinf or not iloc:
+        raise ValueError("iinf or iloc box not found")
+    item_id = find_heif_item_id(read_box(fp, *iinf), b"Exif")
+    if item_id is None:
+        return None
+    item_offset = find_heif_item_offset(read_box(fp, *iloc), item_id)
+    if item_offset is None:
+        raise ValueError("exif item location not found")
+    # the exif item starts with the offset to the TIFF header, usually past "Exif\0\0"
+    fp.seek(item_offset)
+    (tiff_header_offset,) = struct.unpack(">I", fp.read(4))
+    return read(fp, item_offset + 4 + tiff_header_offset)
+
+
+def read_pyheif_exif_date(filepath):
+    """
+    reads the date of creation of the image using pyheif without decoding it
+    slower than read_heif_exif_date() but more tolerant of malformed files
+    """
+    if is_read_budget_set(filepath):
+        return None
+    import piexif
+    import pyheif
+
+    try:
+        image = pyheif.open(filepath)
+    except pyheif.error.HeifError:
+        logger.debug("unable to parse '%s'", filepath)
+        return None
+
+    for data in image.metadata or []:
+        if data["type"] == "Exif":
+            exif = piexif.load(data["data"])
+            date_created = (
+                exif.get("Exif", {}).get(TAG_DATETIME_ORIGINAL, b"").decode("utf-8")
+            )
+            if date_created:
+                date_created += "." + exif.get("Exif", {}).get(
+                    TAG_SUBSECTIME_ORIGINAL, b""
+                ).decode("utf-8").zfill(3)
+            return date_created
+    return None
+
+
+@timed("extract_heif")
+def get_original_date_heif(filepath):
+    """
+    returns the DateTimeOriginal exif data from the given heif file
+    only the boxes locating the exif data are read, the image is never decoded.
+    falls back to pyheif for malformed files
+    """
+    try:
+        with open_media(filepath) as fp:
+            date_created = read_heif_exif_date(fp)
+    except (ValueError, struct.error, IndexError):
+        logger.debug("falling back to pyheif to parse '%s'", filepath)
+        date_created = read_pyheif_exif_date(filepath)
+
+    if date_created:
+        date_created = parse_jpeg_date(date_created)
+
+    return date_created
+
+
+def read_mvhd(mvhd):
+    """returns the encoded date and the duration in milliseconds from a mvhd box payload"""
+    if not mvhd:
+        raise ValueError("empty mvhd box")
+    if mvhd[0] == 1:  # version 1 uses 64 bit times and duration
+        creation_time, _, timescale, duration = struct.unpack_from(">QQIQ", mvhd, 4)
+    else:
+        creation_time, _, timescale, duration = struct.unpack_from(">IIII", mvhd, 4)
+    encoded_date = None
+    if creation_time:
+        try:
+            date = MP4_EPOCH + datetime.timedelta(seconds=creation_time)
+        except OverflowError as e:
+            raise ValueError(f"invalid mvhd creation time {creation_time}") from e
+        encoded_date = date.strftime("%Y-%m-%d %H:%M:%S UTC")
+    if timescale:
+        duration = round(duration * 1000 / timescale)
+    return encoded_date, duration or None
+
+
+def read_udta_string(udta_item):
+    """returns the string of a quicktime udta text item such as ©xyz"""
+    (length,) = struct.unpack_from(">H", udta_item)  # followed by a language code
+    return str(udta_item[4 : 4 + length], "utf-8", "replace")
+
+
+def read_quicktime_metadata(fp, meta_start, meta_end, key):
+    """
+    returns the string value of the given key from the keys/ilst boxes of a
+    quicktime meta box. None if the key isn't found
+    """
+    keys = find_box(fp, b"keys", meta_start, meta_end)
+    ilst = find_box(fp, b"ilst", meta_start, meta_end)
+    if not keys or not ilst:
+        return None
+    data = read_box(fp, *keys)
+    (entry_count,) = struct.unpack_from(">I", data, 4)  # after version and flags
+    pos = 8
+    key_index = None
+    for i in range(1, entry_count + 1):
+        size, _ = struct.unpack_from(">I4s", data, pos)  # size and namespace
+        if size < 8:
+            raise ValueError("invalid key size")
+        if data[pos + 8 : pos + size] == key:
+            key_index = i
+            break
+        pos += size
+    if key_index is None:
+        return None
+    for kind, item_start, item_end in iter_boxes(fp, *ilst):
+        if int.from_bytes(kind, "big") == key_index:
+            value = find_box(fp, b"data", item_start, item_end)
+            if value:
+                value = read_box(fp, *value)
+                # data: type(4) locale(4) value
+                if int.from_bytes(value[:4], "big") == MP4_DATA_TYPE_UTF8:
+                    return str(value[8:], "utf-8", "replace")
+    return None
+
+
+def read_mp4_metadata(fp):
+    """
+    reads the moov/mvhd, moov/udta and moov/meta boxes of the mp4/mov file
+    returns a dictionary named after the equivalent mediainfo general track fields:
+    encoded_date, xyz, duration and comapplequicktimecreationdate
+    the boxes are located by seeking past their headers, so the media data and
+    tracks are never read even when the moov box is at the end of the file
+    """
+    metadata = dict.fromkeys(
+        ("encoded_date", "xyz", "duration", "comapplequicktimecreationdate")
+    )
+    moov = find_box(fp, b"moov", 0)
+    if not moov:
+        raise ValueError("moov box not found")
+    for kind, payload_start, payload_end in iter_boxes(fp, *moov):
+        if kind == b"mvhd":
+            metadata["encoded_date"], metadata["duration"] = read_mvhd(
+                read_box(fp, payload_start, payload_end)
+            )
+        elif kind == b"udta":
+            xyz = find_box(fp, b"\xa9xyz", payload_start, payload_end)
+            if xyz:
+                metadata["xyz"] = read_udta_string(read_box(fp, *xyz))
+        elif kind == b"meta":
+            # in mp4 files meta is a full box, in quicktime files it isn't
+            fp.seek(payload_start + 4)
+            if fp.read(4) != b"hdlr":
+                payload_start += 4
+            metadata["comapplequicktimecreationdate"] = read_quicktime_metadata(
+                fp, payload_start, payload_end, QUICKTIME_CREATIONDATE_KEY
+            )
+    return metadata
+
+
+@functools.cache
+def import_mediainfo():
+    """returns the pymediainfo module, None if it isn't installed"""
+    try:
+        import pymediainfo
+    except ImportError:
+        return None
+    return pymediainfo
+
+
+def read_mediainfo_metadata(filepath):
+    """
+    reads the same fields as read_mp4_metadata() using mediainfo
+    slower since it analyses every track, but more tolerant of malformed files
+    returns None if pymediainfo or the mediainfo library aren't installed
+    """
+    if is_read_budget_set(filepath):
+        return None
+    pymediainfo = import_mediainfo()
+    if pymediainfo is None or not pymediainfo.MediaInfo.can_parse():
+        logger.debug("unable to parse '%s', mediainfo isn't available", filepath)
+        return None
+    general_track = pymediainfo.MediaInfo.parse(filepath).general_tracks[0]
+    return {
+        "encoded_date": general_track.encoded_date,
+        "xyz": general_track.xyz,
+        "duration": general_track.duration,
+        "comapplequicktimecreationdate": general_track.comapplequicktimecreationdate,
+    }
+
+
+def get_video_metadata(filepath):
+    """
+    returns the metadata of the given mp4/mov file. see read_mp4_metadata()
+    falls back to mediainfo for malformed files
+    """
+    try:
+        with open_media(filepath) as fp:
+            return read_mp4_metadata(fp)
+    except (ValueError, struct.error):
+        logger.debug("falling back to mediainfo to parse '%s'", filepath)
+        return read_mediainfo_metadata(filepath) or {}
+
+
+@timed("extract_mov")
+def get_original_date_mov(filepath):
+    """returns the creation time data from the given mov file"""
+    metadata = get_video_metadata(filepath)
+    date_created = parse_mov_date(metadata.get("comapplequicktimecreationdate"))
+    return date_created
+
+
+@timed("extract_mp4")
+def get_original_date_mp4(filepath):
+    """returns the creation time data from the given mp4 file"""
+    metadata = get_video_metadata(filepath)
+    date_created = parse_mp4_date(
+        metadata.get("encoded_date"), metadata.get("xyz"), metadata.get("duration")
+    )
+    return date_created
+
+
+def read_png_date(fp):
+    """
+    walks the chunks preceding the image data of the png file, reading the date
+    of creation from the eXIf chunk, or else from the Creation Time tEXt chunk
+    returns a string, see parse_png_date()
+    """
+    if fp.read(8) != PNG_SIGNATURE:
+        raise ValueError("not a png file")
+    text_date = None
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            raise ValueError("invalid png chunk")
+        length, kind = struct.unpack(">I4s", header)
+        start = fp.tell()
+        if kind in (b"IDAT", b"IEND"):
+            return text_date
+        if kind == b"eXIf":
+            # some writers keep the prefix of the jpeg APP1 segment
+            base = start + 6 if fp.read(6) == EXIF_HEADER else start
+            date_created = read_exif_date(fp, base)
+            if date_created:
+                return date_created
+        elif kind == b"tEXt" and length <= PNG_MAX_TEXT_LENGTH:
+            keyword, _, text = fp.read(length).partition(b"\x00")
+            if keyword == PNG_CREATION_TIME and text_date is None:
+                text_date = text.decode("latin-1").strip()
+        fp.seek(start + length + 4)  # skips the crc
+
+
+def read_webp_exif_date(fp, read=read_exif_date):
+    """
+    walks the chunks of the webp file until the EXIF chunk, reading only their
+    headers. files without the EXIF flag in their VP8X chunk aren't walked
+    see read_exif_date()
+    read: function reading the exif TIFF structure, such as read_exif_model()
+    """
+    header = fp.read(12)
+    if header[:4] != b"RIFF" or header[8:] != b"WEBP":
+        raise ValueError("not a webp file")
+    end = 8 + struct.unpack("<I", header[4:8])[0]
+    position = 12
+    while position + 8 <= end:
+        fp.seek(position)
+        chunk = fp.read(9)
+        if len(chunk) < 9:
+            raise ValueError("invalid webp chunk")
+        kind, length, flags = struct.unpack("<4sIB", chunk)
+        if position == 12 and (kind != b"VP8X" or not flags & WEBP_VP8X_EXIF):
+            # simple files can't hold metadata
+            return None
+        if kind == b"EXIF":
+            fp.seek(position + 8)
+            base = position + 14 if fp.read(6) == EXIF_HEADER else position + 8
+            return read(fp, base)
+        position += 8 + length + (length & 1)
+    return None
+
+
+@timed("extract_png")
+def get_original_date_png(filepath):
+    """returns the date of creation from the eXIf or tEXt chunks of the given png file"""
+    try:
+        with open_media(filepath) as fp:
+            date_created = read_png_date(fp)
+    except (ValueError, struct.error):
+        logger.debug("unable to parse '%s'", filepath)
+        return None
+    return parse_png_date(date_created) if date_created else None
+
+
+@timed("extract_webp")
+def get_original_date_webp(filepath):
+    """returns the DateTimeOriginal exif data from the given webp file"""
+    try:
+        with open_media(filepath) as fp:
+            date_created = read_webp_exif_date(fp)
+    except (ValueError, struct.error):
+        logger.debug("unable to parse '%s'", filepath)
+        return None
+    return parse_jpeg_date(date_created) if date_created else None
+
+
+@timed("extract_raw")
+def get_original_date_raw(filepath):
+    """
+    returns the DateTimeOriginal exif data from the given TIFF based raw file,
+    such as cr2, nef, dng and arw files. only the first IFDs are read
+    """
+    try:
+        with open_media(filepath) as fp:
+            date_created = read_exif_date(fp, 0)
+    except (ValueError, struct.error):
+        logger.debug("unable to parse '%s'", filepath)
+        return None
+    return parse_jpeg_date(date_created) if date_created else None
+
+
+Extractor = collections.namedtuple(
+    "Extractor", ["name", "function", "suffixes", "sniff"]
+)
+EXTRACTORS = {}  # { name: Extractor }, see register_extractor()
+EXTRACTORS_BY_SUFFIX = {}  # { suffix: Extractor }
+
+
+def register_extractor(name, function, suffixes=(), sniff=None):
+    """
+    registers a function returning the date of creation of a file, or None
+    suffixes: lowercase suffixes of the files it parses, such as ".jpg"
+    sniff: function given the first SNIFF_SIZE bytes of a file, returning whether
+           the file is of this type. files are recognized by their contents
+           first, so misnamed files reach the right extractor
+    an extractor registered later on takes precedence, even with the same name
+    """
+    extractor = Extractor(name, function, tuple(suffixes), sniff)
+    EXTRACTORS.pop(name, None)
+    EXTRACTORS[name] = extractor
+    for suffix in extractor.suffixes:
+        EXTRACTORS_BY_SUFFIX[suffix] = extractor
+        SUPPORTED_SUFFIXES.add(suffix)
+
+
+@functools.cache
+def load_extractor_plugins():
+    """
+    registers the extractors of the installed plugins, once per process
+    a plugin declares an entry point in the rename_images.extractors group
+    referring to a function, called with register_extractor() as its argument
+    """
+    import importlib.metadata
+
+    for entry_point in importlib.metadata.entry_points(
+        group=EXTRACTORS_ENTRY_POINT_GROUP
+    ):
+        try:
+            entry_point.load()(register_extractor)
+        except Exception as e:  # a broken plugin doesn't stop the run
+            logger.error(
+                "unable to load the extractor plugin %s: %s", entry_point.name, e
+            )
+
+
+@timed("sniff")
+def sniff_extractor(filepath):
+    """returns the extractor recognizing the first bytes of the file, None if none does"""
+    try:
+        with open_media(filepath) as fp:
+            header = fp.read(SNIFF_SIZE)
+    except (OSError, ReadBudgetExceeded):
+        return None
+    for extractor in reversed(EXTRACTORS.values()):
+        if extractor.sniff and extractor.sniff(header):
+            return extractor
+    return None
+
+
+def get_original_date(filepath):
+    """
+    returns the date of creation of the given file according to its type
+    the type is recognized by the first bytes of the file, or else its suffix
+    returns None if the file type isn't supported or if no date was found
+    """
+    if ENGINE["exiftool"]:
+        return ENGINE["exiftool"].get_dates([filepath])[0]
+    with share_media(filepath):
+        extractor = sniff_extractor(filepath) or EXTRACTORS_BY_SUFFIX.get(
+            filepath.suffix.lower()
+        )
+        if extractor is None:
+            return None
+        try:
+            return extractor.function(filepath)
+        except ReadBudgetExceeded as e:
+            logger.warning("unable to parse '%s': %s", filepath, e)
+            return None
+
+
+def get_ftyp_brand(header):
+    """returns the major brand of an ISO base media file, None if it isn't one"""
+    return header[8:12] if header[4:8] == b"ftyp" else None
+
+
+register_extractor(
+    "jpeg",
+    get_original_date_jpeg,
+    (".jpg", ".jpeg"),
+    lambda header: header.startswith(JPEG_SOI + b"\xff"),
+)
+register_extractor(
+    "heif",
+    get_original_date_heif,
+    (".heic",),
+    lambda header: get_ftyp_brand(header) in HEIF_BRANDS,
+)
+register_extractor(
+    "mov",
+    get_original_date_mov,
+    (".mov",),
+    lambda header: get_ftyp_brand(header) == QUICKTIME_BRAND
+    or header[4:8] in QUICKTIME_BOXES,
+)
+register_extractor(
+    "mp4",
+    get_original_date_mp4,
+    (".mp4",),
+    lambda header: get_ftyp_brand(header) in MP4_BRANDS,
+)
+register_extractor(
+    "png", get_original_date_png, (".png",), lambda header: header[:8] == PNG_SIGNATURE
+)
+register_extractor(
+    "webp",
+    get_original_date_webp,
+    (".webp",),
+    lambda header: header[:4] == b"RIFF" and header[8:12] == b"WEBP",
+)
+register_extractor(
+    "raw",
+    get_original_date_raw,
+    (".cr2", ".nef", ".dng", ".arw"),
+    lambda header: header[:4] in (b"II*\x00", b"MM\x00*"),
+)
+
+# walkers of the files holding exif metadata by extractor name, called with the
+# function reading the exif TIFF structure. see get_camera_model()
+EXIF_READERS = {
+    "jpeg": read_jpeg_exif_date,
+    "heif": read_heif_exif_date,
+    "webp": read_webp_exif_date,
+    "raw": lambda fp, read: read(fp, 0),
+}
+
+
+def get_camera_model(filepath):
+    """
+    returns the model of the camera found in the exif metadata of the image, made
+    safe to use in file names. None if not found or the file doesn't hold exif
+    metadata. see EXIF_READERS
+    """
+    with share_media(filepath):
+        extractor = sniff_extractor(filepath)
+        read = EXIF_READERS.get(extractor.name) if extractor else None
+        if read is None:
+            return None
+        try:
+            with open_media(filepath) as fp:
+                model = read(fp, read_exif_model)
+        except (OSError, ValueError, struct.error, ReadBudgetExceeded):
+            logger.debug("unable to read the camera model of '%s'", filepath)
+            return None
+    if not model:
+        return None
+    return re.sub(r"[^\w\- ]+", "-", model).strip("- ") or None
+
+
+class ExiftoolBackend:
+    """
+    parses files with a single long lived exiftool process, see its -stay_open option
+    the paths are sent in batches of batch_size files. larger batches take fewer
+    round trips, smaller ones return the first dates sooner
+    the process is started on first use and restarted if it dies, the batch it
+    was parsing is sent once more before its files are given up on
+    command: exiftool or a compatible program, as a list of arguments
+    """
+
+    def __init__(self, command, batch_size=DEFAULT_EXIFTOOL_BATCH_SIZE):
+        self.command = list(command)
+        self.batch_size = batch_size
+        self.process = None
+        self.requests = 0
+        self.failed = set()  # files of the batches given up on, not to be cached
+        self.lock = threading.Lock()  # a single request is in flight at a time
+
+    def start(self):
+        """starts the exiftool process"""
+        import subprocess
+
+        self.process = subprocess.Popen(
+            [*self.command, "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def request(self, files):
+        """
+        sends the batch of files to the exiftool process
+        returns the parsed json output, a list of { tag: value }
+        raises OSError or ValueError if the process died or its output is invalid
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        self.requests += 1
+        ready = f"{{ready{self.requests}}}".encode()
+        args = [*EXIFTOOL_ARGS, *map(os.fsdecode, files), f"-execute{self.requests}"]
+        self.process.stdin.write(("\n".join(args) + "\n").encode("utf-8"))
+        self.process.stdin.flush()
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise OSError("exiftool exited unexpectedly")
+            if line.rstrip() == ready:
+                break
+            output.append(line)
+        output = b"".join(output).strip()
+        # nothing is printed if none of the files could be read
+        return json.loads(output) if output else []
+
+    @timed("extract_exiftool")
+    def get_dates(self, files):
+        """returns the dates of creation of the files, None for those without one"""
+        # the paths are sent one per line
+        batch = [filepath for filepath in files if "\n" not in os.fsdecode(filepath)]
+        entries = []
+        with self.lock:
+            for _ in range(2):
+                try:
+                    entries = self.request(batch) if batch else []
+                    break
+                except (OSError, ValueError) as e:
+                    logger.warning("restarting exiftool: %s", e)
+                    self.close()
+            else:
+                logger.error("unable to parse %s files with exiftool", len(batch))
+                self.failed.update(batch)
+        by_path = {entry.get("SourceFile"): entry for entry in entries}
+        return [
+            parse_exiftool_entry(by_path.get(os.fsdecode(filepath), {}))
+            for filepath in files
+        ]
+
+    def close(self):
+        """stops the exiftool process"""
+        import subprocess
+
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            self.process.stdin.close()
+            self.process.wait(timeout=EXIFTOOL_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+def parse_exiftool_entry(entry):
+    """returns the date of creation from the exiftool json output of a file"""
+    for tag in EXIFTOOL_DATE_TAGS:
+        value = entry.get(tag)
+        if not isinstance(value, str):
+            continue
+        if tag == "DateTimeOriginal" and "SubSecTimeOriginal" in entry:
+            value += "." + str(entry["SubSecTimeOriginal"]).zfill(3)
+        date_created = parse_jpeg_date(value)
+        if date_created:
+            return date_created
+    return None
+
+
+def configure_exiftool(command, batch_size=DEFAULT_EXIFTOOL_BATCH_SIZE):
+    """
+    parses every file with exiftool instead of the native extractors, including
+    the formats only exiftool reads, see ExiftoolBackend and EXIFTOOL_SUFFIXES
+    command: list of arguments starting exiftool, None to use the native extractors
+    """
+    if ENGINE["exiftool"]:
+        ENGINE["exiftool"].close()
+    ENGINE["exiftool"] = None
+    if command:
+        ENGINE["exiftool"] = ExiftoolBackend(command, batch_size)
+        SUPPORTED_SUFFIXES.update(EXIFTOOL_SUFFIXES)
+
+
+class RevertCache:
+    """
+    persistent record of the renames, used to revert them
+    each rename is recorded before it happens and flushed to disk in batches, so
+    an interrupted run keeps the renames made so far. renames are indexed by
+    directory so reverting only reads the entries of the directories involved
+    """
+
+    def __init__(self, filepath):
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS renames (
+                directory TEXT,
+                new_path TEXT,
+                old_path TEXT,
+                PRIMARY KEY (directory, new_path)
+            ) WITHOUT ROWID"""
+        )
+        self.pending = 0
+
+    def import_json(self, filepath):
+        """
+        imports the renames from the json file used by previous versions
+        { directory: { new_path: old_path } }
+        the file is kept as a backup with the .bak suffix
+        """
+        try:
+            data = json.loads(filepath.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO renames VALUES (?, ?, ?)",
+            (
+                (directory, new_path, old_path)
+                for directory, renames in data.items()
+                for new_path, old_path in renames.items()
+            ),
+        )
+        self.connection.commit()
+        filepath.rename(filepath.with_name(filepath.name + ".bak"))
+
+    @timed("revert_cache")
+    def add_batch(self, renames):
+        """
+        records the given renames [(old_path, new_path)] and commits them to disk
+        before any of them happens
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO renames VALUES (?, ?, ?)",
+            (
+                (
+                    os.path.dirname(os.path.abspath(new_path)),
+                    os.path.abspath(new_path),
+                    os.path.abspath(old_path),
+                )
+                for old_path, new_path in renames
+            ),
+        )
+        self.connection.commit()
+        self.pending = 0
+
+    @staticmethod
+    def keys(path):
+        """
+        returns the spellings the path may be recorded under: its absolute path,
+        and the path as given, which earlier versions recorded
+        """
+        keys = [os.path.abspath(path)]
+        if str(path) != keys[0]:
+            keys.append(str(path))
+        return keys
+
+    def get(self, new_path):
+        """returns the path the given file had before being renamed, None if unknown"""
+        for directory, key in zip(self.keys(new_path.parent), self.keys(new_path)):
+            row = self.connection.execute(
+                "SELECT old_path FROM renames WHERE directory = ? AND new_path = ?",
+                (directory, key),
+            ).fetchone()
+            if row:
+                return pathlib.Path(row[0])
+        return None
+
+    def get_directories(self, directory, recursive):
+        """
+        returns { directory: { new_path: old_path } } of the renames recorded for
+        files in the given directory, and in its subdirectories if recursive
+        only the index is read, the filesystem isn't walked
+        """
+        queries = []
+        for key in self.keys(directory):
+            queries.append(("SELECT * FROM renames WHERE directory = ?", (key,)))
+            if not recursive:
+                continue
+            if key == ".":
+                # relative paths recorded by earlier versions don't start with ./
+                queries.append(
+                    (
+                        "SELECT * FROM renames WHERE directory NOT LIKE '/%'"
+                        " AND directory != '..' AND directory NOT LIKE '../%'",
+                        (),
+                    )
+                )
+                continue
+            # the subdirectories sort between the prefix and the prefix ending
+            # with the character after the separator
+            prefix = os.path.join(key, "")
+            end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            queries.append(
+                (
+                    "SELECT * FROM renames WHERE directory >= ? AND directory < ?",
+                    (prefix, end),
+                )
+            )
+        directories = {}
+        for query, parameters in queries:
+            for directory, new_path, old_path in self.connection.execute(
+                query, parameters
+            ):
+                renames = directories.setdefault(pathlib.Path(directory), {})
+                renames[pathlib.Path(new_path)] = pathlib.Path(old_path)
+        return directories
+
+    def has_directory(self, directory):
+        """returns whether renames were recorded for files in the given directory"""
+        return any(
+            self.connection.execute(
+                "SELECT 1 FROM renames WHERE directory = ? LIMIT 1", (key,)
+            ).fetchone()
+            for key in self.keys(directory)
+        )
+
+    @timed("revert_cache")
+    def remove(self, new_path):
+        """forgets the rename of the given file"""
+        self.connection.executemany(
+            "DELETE FROM renames WHERE directory = ? AND new_path = ?",
+            zip(self.keys(new_path.parent), self.keys(new_path)),
+        )
+        self.flush()
+
+    def flush(self):
+        """counts a pending change, committing once enough of them accumulated"""
+        self.pending += 1
+        if self.pending >= CACHE_COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        """commits the pending changes"""
+        self.connection.commit()
+        self.connection.close()
+
+
+class MetadataCache:
+    """
+    persistent cache of the dates of creation parsed from files
+    entries are keyed by the identity of the file (device and inode), so they
+    remain valid after the file is renamed. an entry is evicted once the size or
+    the modification time of the file changes
+    files without a date of creation are cached as well
+    """
+
+    def __init__(self, filepath):
+        self.connection = sqlite3.connect(filepath)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != METADATA_CACHE_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS dates")
+            self.connection.execute(f"PRAGMA user_version = {METADATA_CACHE_VERSION}")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS dates (
+                device INTEGER,
+                inode INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER,
+                date_created TEXT,
+                timezone TEXT,
+                PRIMARY KEY (device, inode)
+            )"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                settings TEXT,
+                mtime_ns INTEGER,
+                entries INTEGER
+            )"""
+        )
+        self.pending = 0
+
+    @timed("metadata_cache")
+    def get(self, stat):
+        """
+        returns (True, date_created) if the file with the given os.stat() result
+        is cached, (False, None) otherwise
+        """
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, date_created, timezone FROM dates"
+            " WHERE device = ? AND inode = ?",
+            (stat.st_dev, stat.st_ino),
+        ).fetchone()
+        if not row:
+            return False, None
+        size, mtime_ns, date_created, timezone = row
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            self.connection.execute(
+                "DELETE FROM dates WHERE device = ? AND inode = ?",
+                (stat.st_dev, stat.st_ino),
+            )
+            return False, None
+        if date_created:
+            date_created = datetime.datetime.fromisoformat(date_created)
+            if timezone:
+                date_created = date_created.astimezone(ZoneInfo(timezone))
+        return True, date_created
+
+    @timed("metadata_cache")
+    def set(self, stat, date_created):
+        """caches the date of creation of the file with the given os.stat() result"""
+        timezone = None
+        if date_created and isinstance(date_created.tzinfo, ZoneInfo):
+            timezone = date_created.tzinfo.key
+        self.connection.execute(
+            "INSERT OR REPLACE INTO dates VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                stat.st_dev,
+                stat.st_ino,
+                stat.st_size,
+                stat.st_mtime_ns,
+                date_created.isoformat() if date_created else None,
+                timezone,
+            ),
+        )
+        self.pending += 1
+        if self.pending >= CACHE_COMMIT_INTERVAL:
+            # an interrupted run keeps most of the dates parsed so far
+            self.commit()
+
+    @timed("metadata_cache")
+    def get_watermark(self, directory, settings):
+        """
+        returns (mtime_ns, entries) of the directory when it was last processed with
+        the given settings, None if it wasn't. see Incremental
+        """
+        row = self.connection.execute(
+            "SELECT mtime_ns, entries FROM directories WHERE path = ? AND settings = ?",
+            (os.path.abspath(directory), settings),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    @timed("metadata_cache")
+    def set_watermark(self, directory, settings, watermark):
+        """records (mtime_ns, entries) of the directory once it was processed"""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+            (os.path.abspath(directory), settings, *watermark),
+        )
+
+    def commit(self):
+        """saves the cached dates, see close()"""
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        """saves the cached dates"""
+        self.connection.commit()
+        self.connection.close()
+
+
+class Incremental:
+    """
+    skips the work already done by previous runs, see --incremental
+    - files whose name starts with a date in the date format aren't parsed, they
+      are assumed to be renamed already
+    - directories that didn't change since they were last processed are skipped.
+      they're recognized by their modification time and their number of entries,
+      so files modified in place aren't noticed
+    the watermarks of the directories are kept in the metadata cache
+    """
+
+    def __init__(self, metadata_cache, pattern, date_format, exclude=None):
+        self.metadata_cache = metadata_cache
+        self.renamed_name = compile_date_format(date_format)
+        self.settings = json.dumps(
+            [
+                getattr(pattern, "pattern", pattern),
+                date_format,
+                exclude.pattern if exclude else None,
+            ]
+        )
+
+    def select(self, directory, stat, names, files):
+        """
+        returns the files of the directory that need to be processed
+        stat: os.stat() result of the directory, taken before it was listed
+        names: names of the entries of the directory, see list_names()
+        """
+        watermark = (stat.st_mtime_ns, len(names))
+        if self.metadata_cache.get_watermark(directory, self.settings) == watermark:
+            STATS.count("directories_skipped")
+            return []
+        selected = [
+            filepath for filepath in files if not self.renamed_name.match(filepath.name)
+        ]
+        STATS.count("files_skipped", len(files) - len(selected))
+        if not selected:
+            # there's nothing to rename, the directory is as it will be left
+            self.metadata_cache.set_watermark(directory, self.settings, watermark)
+        return selected
+
+    def mark(self, directory, names, stat=None):
+        """
+        records the watermark of the directory once its files were renamed
+        stat: os.stat() result of the directory after the renames, read if not given
+        """
+        if stat is None:
+            try:
+                stat = os.stat(directory)
+            except OSError as e:
+                logger.error(e)
+                return
+        self.metadata_cache.set_watermark(
+            directory, self.settings, (stat.st_mtime_ns, len(names))
+        )
+
+
+class PlanWriter:
+    """
+    stands in for the renamed dictionary, streaming the renames to a file instead
+    of keeping them in memory. each rename is written as a line of json
+        {"old": old_path, "new": new_path}
+    a rename that failed afterwards is followed by {"old": old_path, "new": null}
+    the plan can be applied later on without parsing the files again, see apply_plan()
+    new_paths: optional set filled with the new paths, see watch()
+    """
+
+    def __init__(self, fp, new_paths=None):
+        self.fp = fp
+        self.count = 0
+        self.new_paths = new_paths
+
+    def __setitem__(self, filepath, new_path):
+        self.fp.write(json.dumps({"old": str(filepath), "new": str(new_path)}) + "\n")
+        self.count += 1
+        if self.new_paths is not None:
+            self.new_paths.add(new_path)
+
+    def pop(self, filepath, default=None):
+        self.fp.write(json.dumps({"old": str(filepath), "new": None}) + "\n")
+        self.count -= 1
+        return default
+
+    def __len__(self):
+        return self.count
+
+
+def iter_plan_entries(fp):
+    """
+    yields (line_number, filepath, new_path) for each line of a plan written by
+    PlanWriter, new_path is None for a retracted rename
+    """
+    for line_number, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            filepath = pathlib.Path(entry["old"])
+            new_path = entry["new"] and pathlib.Path(entry["new"])
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"invalid plan entry on line {line_number}: {e}") from e
+        yield line_number, filepath, new_path or None
+
+
+def read_plan(fp):
+    """
+    reads a plan written by PlanWriter, one directory at a time
+    yields (directory, { filepath: new_path }) for each run of consecutive renames
+    of the same directory, so only a single directory is held in memory
+    renames run concurrently, so a retraction may be written after the renames of
+    other directories. the retractions are read first, the file is read twice
+    """
+    start = fp.tell()
+    retracted = {
+        filepath: line_number
+        for line_number, filepath, new_path in iter_plan_entries(fp)
+        if new_path is None
+    }
+    fp.seek(start)
+
+    directory = None
+    plan = {}
+    for line_number, filepath, new_path in iter_plan_entries(fp):
+        if new_path is None or retracted.get(filepath, 0) > line_number:
+            continue
+        if filepath.parent != directory:
+            if plan:
+                yield directory, plan
+            directory = filepath.parent
+            plan = {}
+        plan[filepath] = new_path
+    if plan:
+        yield directory, plan
+
+
+def list_names(directory):
+    """returns the names of the entries of the directory, listed in a single pass"""
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries}
+
+
+def compile_exclude_patterns(patterns):
+    """
+    compiles the given glob patterns into a single regex, see fnmatch
+    returns None if no patterns were given
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+
+def walk_directories(
+    filepath, recursive, exclude=None, max_depth=None, incremental=None
+):
+    """
+    yields (directory, names, files) for the given directory and its subdirectories
+    names: names of all the entries of the directory, see list_names()
+    files: the supported files of the directory
+
+    the tree is walked iteratively with a single os.scandir pass per directory.
+    entries are filtered by their suffix before any path object is created
+    exclude: regex of entries to skip, matched against their name and their path
+             relative to the given directory. see compile_exclude_patterns()
+    max_depth: number of levels of subdirectories to recurse into, None for unlimited
+    incremental: Incremental selecting the files to process, optional
+    """
+    stack = [(filepath, "", 0)]
+    while stack:
+        directory, relative, depth = stack.pop()
+        descend = recursive and (max_depth is None or depth < max_depth)
+        try:
+            stat = os.stat(directory) if incremental else None
+            names, files, subdirectories = scan_directory(
+                directory, relative, descend, exclude
+            )
+        except OSError as e:
+            logger.error(e)
+            continue
+        if incremental:
+            files = incremental.select(directory, stat, names, files)
+        yield directory, names, files
+        stack.extend(
+            (subdirectory, subdirectory_relative, depth + 1)
+            for subdirectory, subdirectory_relative in reversed(subdirectories)
+        )
+
+
+def scan_directory(directory, relative, descend, exclude):
+    """
+    lists the directory in a single os.scandir pass, see walk_directories()
+    relative: path of the directory relative to the one being walked, ending in /
+    descend: whether to return the subdirectories
+    returns (names, files, [(subdirectory, relative path of the subdirectory)])
+    """
+    names = set()
+    files = []
+    subdirectories = []
+    with STATS.time("walk"), os.scandir(directory) as entries:
+        for entry in entries:
+            names.add(entry.name)
+            if exclude and (
+                exclude.match(entry.name) or exclude.match(relative + entry.name)
+            ):
+                continue
+            if entry.is_file():
+                suffix = os.path.splitext(entry.name)[1].lower()
+                if suffix in SUPPORTED_SUFFIXES:
+                    files.append(pathlib.Path(entry.path))
+            elif descend and entry.is_dir():
+                subdirectories.append(
+                    (pathlib.Path(entry.path), f"{relative}{entry.name}/")
+                )
+    return names, files, subdirectories
+
+
+def iter_files(
+    filepath, recursive, names=None, exclude=None, max_depth=None, incremental=None
+):
+    """
+    yields the supported files found in the given directory, see walk_directories()
+    names: optional dictionary filled with { directory: names of its entries }
+           for every directory with supported files, see list_names()
+    """
+    for directory, directory_names, files in walk_directories(
+        filepath, recursive, exclude, max_depth, incremental
+    ):
+        if names is not None and files:
+            names[directory] = directory_names
+        yield from files
+
+
+def init_worker(
+    timezone_precision, timezone_in_memory, collect_stats, max_read_bytes, drop_cache
+):
+    """initializes a worker process with the settings of the main process"""
+    load_extractor_plugins()
+    configure_timezone_lookup(timezone_precision, timezone_in_memory)
+    configure_media_reader(max_read_bytes, drop_cache)
+    STATS.enabled = collect_stats
+
+
+def get_original_date_with_stats(filepath):
+    """
+    get_original_date() for worker processes collecting stats
+    returns (date_created, durations, counters), see Stats.merge()
+    """
+    STATS.clear()
+    date_created = get_original_date(filepath)
+    return date_created, STATS.durations, STATS.counters
+
+
+def iter_dates(files, jobs=1, metadata_cache=None):
+    """
+    yields (filepath, date_created) for each of the given files, in order
+    the files are consumed as they come: the metadata cache is consulted first and
+    the remaining files are parsed one at a time, or in batches by exiftool if
+    configured. with jobs > 1, all the files are listed first so the ones missing
+    from the cache can be handed to a pool of worker processes
+    """
+    exiftool = ENGINE["exiftool"]
+    if jobs > 1 and not exiftool:
+        yield from iter_dates_in_pool(files, jobs, metadata_cache)
+        return
+    files = iter(files)
+    batch_size = exiftool.batch_size if exiftool else 1
+    while batch := list(itertools.islice(files, batch_size)):
+        cached, stats = lookup_metadata_cache(batch, metadata_cache)
+        missing = [filepath for filepath in batch if filepath not in cached]
+        if exiftool:
+            dates = iter(exiftool.get_dates(missing) if missing else ())
+        else:
+            dates = map(get_original_date, missing)
+        yield from merge_dates(batch, cached, stats, dates, metadata_cache)
+
+
+def iter_dates_in_pool(files, jobs, metadata_cache=None):
+    """iter_dates() parsing the files missing from the cache in worker processes"""
+    import concurrent.futures
+
+    files = list(files)
+    cached, stats = lookup_metadata_cache(files, metadata_cache)
+    missing = [filepath for filepath in files if filepath not in cached]
+    if not missing:
+        yield from merge_dates(files, cached, stats, iter(()), metadata_cache)
+        return
+
+    def merge_worker_stats(results):
+        for date_created, durations, counters in results:
+            STATS.merge(durations, counters)
+            yield date_created
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_worker,
+        initargs=(
+            TIMEZONE_LOOKUP["precision"],
+            TIMEZONE_LOOKUP["in_memory"],
+            STATS.enabled,
+            MEDIA_READER["max_bytes"],
+            MEDIA_READER["drop_cache"],
+        ),
+    )
+    try:
+        if STATS.enabled:
+            dates = merge_worker_stats(
+                executor.map(
+                    get_original_date_with_stats, missing, chunksize=JOBS_CHUNKSIZE
+                )
+            )
+        else:
+            dates = executor.map(get_original_date, missing, chunksize=JOBS_CHUNKSIZE)
+        yield from merge_dates(files, cached, stats, dates, metadata_cache)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def lookup_metadata_cache(files, metadata_cache):
+    """
+    returns ({ filepath: date_created }, { filepath: os.stat() result }) for the
+    files found in the metadata cache and the files looked up. empty without cache
+    """
+    cached = {}
+    stats = {}
+    if metadata_cache is None:
+        return cached, stats
+    for filepath in files:
+        stats[filepath] = filepath.stat()
+        hit, date_created = metadata_cache.get(stats[filepath])
+        if hit:
+            cached[filepath] = date_created
+    STATS.count("metadata_cache_hits", len(cached))
+    return cached, stats
+
+
+def merge_dates(files, cached, stats, dates, metadata_cache):
+    """
+    yields (filepath, date_created) for the files in order, taking the date of
+    the files that weren't cached from dates, and caching it
+    """
+    for filepath in files:
+        logger.debug("processing file: %s", filepath)
+        STATS.count("files")
+        if filepath in cached:
+            yield filepath, cached[filepath]
+            continue
+        date_created = next(dates)
+        if metadata_cache is not None and is_cacheable(filepath, date_created):
+            metadata_cache.set(stats[filepath], date_created)
+        yield filepath, date_created
+
+
+def is_cacheable(filepath, date_created):
+    """
+    returns whether the date parsed from the file may be kept in the metadata
+    cache. files exiftool gave up on weren't parsed, and files without a date may
+    have been cut short by the read budget. they're parsed again on later runs
+    """
+    exiftool = ENGINE["exiftool"]
+    if exiftool and filepath in exiftool.failed:
+        return False
+    return date_created is not None or MEDIA_READER["max_bytes"] is None
+
+
+def process_path(
+    filepath,
+    recursive,
+    pattern,
+    date_format,
+    dry_run,
+    cache,
+    renamed,
+    jobs=1,
+    metadata_cache=None,
+    exclude=None,
+    max_depth=None,
+    incremental=None,
+):
+    """
+    process the given image file or directory containing images
+
+    jobs: number of worker processes used to parse the dates of creation. the
+          files are renamed serially afterwards in the same order as a serial run
+    metadata_cache: MetadataCache consulted before parsing the files, optional
+    exclude, max_depth: filter the directories walked, see walk_directories()
+    incremental: Incremental skipping the work of previous runs, optional
+    """
+    if filepath.is_dir():
+        process_directory(
+            filepath,
+            recursive,
+            pattern,
+            date_format,
+            dry_run,
+            cache,
+            renamed,
+            jobs,
+            metadata_cache,
+            exclude,
+            max_depth,
+            incremental,
+        )
+    else:
+        process_file(
+            filepath, pattern, date_format, dry_run, cache, renamed, metadata_cache
+        )
+
+
+def process_directory(
+    filepath,
+    recursive,
+    pattern,
+    date_format,
+    dry_run,
+    cache,
+    renamed,
+    jobs=1,
+    metadata_cache=None,
+    exclude=None,
+    max_depth=None,
+    incremental=None,
+):
+    """iterates over entries in the directory renaming files if needed"""
+    names = {}
+    files = iter_files(filepath, recursive, names, exclude, max_depth, incremental)
+    batch = []
+
+    def rename_batch():
+        directory = batch[0][0].parent
+        failures = rename_files(
+            batch, pattern, date_format, dry_run, cache, renamed, names[directory]
+        )
+        if incremental and not dry_run and is_complete(batch, failures):
+            incremental.mark(directory, names[directory])
+        del names[directory]
+
+    for child, date_created in iter_dates(files, jobs, metadata_cache):
+        if batch and child.parent != batch[0][0].parent:
+            # the files of a directory are yielded together, it's complete
+            rename_batch()
+            batch = []
+        batch.append((child, date_created))
+    if batch:
+        rename_batch()
+
+
+def process_file(
+    filepath, pattern, date_format, dry_run, cache, renamed, metadata_cache=None
+):
+    """parses the date created from the file and renames it if needed"""
+    if filepath.suffix.lower() not in SUPPORTED_SUFFIXES:
+        return
+    files = list(iter_dates([filepath], metadata_cache=metadata_cache))
+    rename_files(
+        files,
+        pattern,
+        date_format,
+        dry_run,
+        cache,
+        renamed,
+        list_names(filepath.parent),
+    )
+
+
+def rename_files(files, pattern, date_format, dry_run, cache, renamed, names):
+    """
+    renames a batch of files of the same directory according to their dates of
+    creation, see plan_renames(), order_renames() and record_renames()
+    files: [(filepath, date_created)]
+    names: names of the entries in the directory, see list_names()
+           kept up to date with the renames, including the ones of a dry run
+    returns the steps that failed, see execute_renames()
+    """
+    plan = plan_renames(files, pattern, date_format, names)
+    return apply_renames(plan, dry_run, cache, renamed, names)
+
+
+def apply_renames(plan, dry_run, cache, renamed, names):
+    """
+    renames the files of a single directory following the plan { filepath: new_path }
+    see record_renames(), execute_renames() and settle_renames()
+    returns the steps that failed
+    """
+    steps = record_renames(plan, dry_run, cache, renamed, names)
+    if not steps:
+        return []
+    failures = execute_renames(steps, names)
+    settle_renames(steps, failures, plan, cache, renamed)
+    return failures
+
+
+def is_complete(files, failures):
+    """
+    returns whether a directory is done with once its files were renamed, so
+    --incremental runs may skip it. the directory is processed again if a rename
+    failed or a file wasn't cacheable, its modification time wouldn't tell
+    files: [(filepath, date_created)]
+    failures: the steps that failed, see execute_renames()
+    """
+    return not failures and all(
+        is_cacheable(filepath, date_created) for filepath, date_created in files
+    )
+
+
+def plan_renames(files, pattern, date_format, names):
+    """
+    decides the new paths of a batch of files of the same directory
+    files: [(filepath, date_created)] in the order they were listed
+    names: names of the entries in the directory, see list_names()
+
+    the files being renamed release their current names, so a file may take the
+    name of another file of the batch that moves away. collisions are otherwise
+    resolved in order by generate_new_filename()
+    returns { filepath: new_path } for the files to be renamed
+    """
+    moving = []
+    for filepath, date_created in files:
+        if date_created:
+            moving.append((filepath, date_created))
+        else:
+            logger.warning("unable to find date of creation for: %s", filepath)
+
+    while True:
+        taken = names.difference(filepath.name for filepath, _ in moving)
+        plan = {}
+        for filepath, date_created in moving:
+            new_path = generate_new_filename(
+                filepath, pattern, date_created, date_format, taken
+            )
+            if filepath != new_path and new_path.name not in taken:
+                plan[filepath] = new_path
+                taken.add(new_path.name)
+            elif filepath.name in taken:
+                # the file keeps its name but another file of the batch took it,
+                # plan again without releasing the name of this file
+                moving.remove((filepath, date_created))
+                break
+            else:
+                taken.add(filepath.name)
+        else:
+            return plan
+
+
+def order_renames(plan, names):
+    """
+    orders the renames so that no file is renamed over a file that hasn't moved
+    yet. cycles of renames are broken by moving a file to a temporary name first
+    plan: { filepath: new_path } of a single directory, see plan_renames()
+    names: names of the entries in the directory, see list_names()
+    returns [(filepath, source, target)] where filepath is the original path
+    """
+    by_name = {filepath.name: filepath for filepath in plan}
+    # waiting: { name: file waiting for the file with that name to move }
+    waiting = {}
+    ready = collections.deque()
+    for filepath, new_path in plan.items():
+        if new_path.name in by_name:
+            waiting[new_path.name] = filepath
+        else:
+            ready.append(filepath)
+
+    targets = {new_path.name for new_path in plan.values()}
+    steps = []
+    moved = set()
+
+    def move_chain(filepath):
+        # renames the file, then the files that were waiting for its name
+        while filepath is not None:
+            steps.append((filepath, filepath, plan[filepath]))
+            moved.add(filepath)
+            filepath = waiting.pop(filepath.name, None)
+
+    while ready:
+        move_chain(ready.popleft())
+
+    for filepath in plan:
+        if filepath in moved:
+            continue
+        # the remaining files form cycles, move one file out of the way
+        temporary = filepath.with_name(TEMPORARY_NAME.format(filepath.name))
+        while temporary.name in names or temporary.name in targets:
+            temporary = temporary.with_name("." + temporary.name)
+        steps.append((filepath, filepath, temporary))
+        moved.add(filepath)
+        waiter = waiting.pop(filepath.name)
+        while waiter is not filepath:
+            steps.append((waiter, waiter, plan[waiter]))
+            moved.add(waiter)
+            waiter = waiting.pop(waiter.name)
+        steps.append((filepath, temporary, plan[filepath]))
+    return steps
+
+
+def record_renames(plan, dry_run, cache, renamed, names):
+    """
+    records the planned renames in renamed and, unless it's a dry run, in the
+    revert cache. the whole batch is committed to the revert cache before any file
+    is renamed, so an interrupted run can be reverted
+    returns the steps of the renames to execute, see order_renames()
+    """
+    if not plan:
+        # nothing to commit, a directory already renamed costs no disk sync
+        return []
+    for filepath, new_path in plan.items():
+        logger.info("renaming %s to %s", filepath, new_path)
+        renamed[filepath] = new_path
+    if dry_run:
+        names.difference_update(filepath.name for filepath in plan)
+        names.update(new_path.name for new_path in plan.values())
+        return []
+
+    steps = order_renames(plan, names)
+    # files moved to a temporary name are recorded with it as well
+    cache.add_batch(
+        list(plan.items())
+        + [
+            (filepath, target)
+            for filepath, _, target in steps
+            if target != plan[filepath]
+        ]
+    )
+    return steps
+
+
+def execute_renames(steps, names):
+    """
+    renames the files following the given steps, see order_renames()
+    a step is skipped when its source is missing or its target is taken, which
+    happens when a step it depends on failed
+    names is kept up to date with the renames
+    returns the steps that failed
+    """
+    failures = []
+    for filepath, source, target in steps:
+        if source.name not in names or target.name in names:
+            logger.error("unable to rename %s to %s", source, target)
+            failures.append((filepath, source, target))
+            continue
+        try:
+            with STATS.time("rename"):
+                source.rename(target)
+        except OSError as e:
+            logger.error(e)
+            failures.append((filepath, source, target))
+            continue
+        names.discard(source.name)
+        names.add(target.name)
+    return failures
+
+
+def settle_renames(steps, failures, plan, cache, renamed):
+    """
+    updates renamed and the revert cache once the steps were executed
+    the renames that failed are forgotten, the records of temporary names are
+    removed unless a file was left with its temporary name
+    """
+    failed = {filepath for filepath, _, _ in failures}
+    for filepath, source, target in steps:
+        if source != filepath and filepath not in failed:
+            cache.remove(source)
+    for filepath, source, target in failures:
+        renamed.pop(filepath, None)
+        cache.remove(plan[filepath])
+        if target != plan[filepath]:
+            cache.remove(target)
+
+
+class RenameTemplate:
+    """
+    compiled form of --pattern and --date-format naming the files, see
+    compile_template(). the pattern is searched once per file and the date is
+    formatted without strftime() for the common directives, see
+    compile_date_formatter(). besides the strftime() directives, the date format
+    may hold placeholders:
+    - {camera}: model of the camera found in the exif metadata, empty if unknown
+    - {orig}: portion of the original name matched by the pattern
+    - {seq}: counter telling apart the files sharing a name, starting at 000
+    without {seq}, a counter is added after the date on collisions only, such as
+    20210620_141545333_001. counters have at least 3 digits and aren't bounded
+    """
+
+    def __init__(self, pattern, date_format):
+        self.pattern = re.compile(pattern)
+        if date_format == DEFAULT_DATE_FORMAT:
+            # names hold milliseconds rather than microseconds, see date_to_string()
+            date_format = date_format[:-2] + "%L"
+        parts = TEMPLATE_PLACEHOLDER.split(date_format)
+        # date formatters and placeholder names before and after {seq}
+        segments = [[]]
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                if part:
+                    segments[-1].append(compile_date_formatter(part))
+            elif part == "seq":
+                segments.append([])
+            else:
+                segments[-1].append(part)
+        if len(segments) > 2:
+            raise ValueError("{seq} can only be used once")
+        self.head = segments[0]
+        self.tail = segments[1] if len(segments) > 1 else None
+        self.uses_camera = "camera" in parts[1::2]
+
+    @staticmethod
+    def join(segments, date_created, fields):
+        """renders the segments with the given date and placeholder values"""
+        if len(segments) == 1 and not isinstance(segments[0], str):
+            return segments[0](date_created)
+        return "".join(
+            fields[segment] if isinstance(segment, str) else segment(date_created)
+            for segment in segments
+        )
+
+    def render(self, filepath, date_created, names):
+        """
+        returns the new path of the file, see generate_new_filename()
+        names: names taken in the directory of the file
+        """
+        name = filepath.name
+        match = self.pattern.search(name)
+        fields = {"orig": match.group() if match else ""}
+        if self.uses_camera:
+            fields["camera"] = get_camera_model(filepath) or ""
+        head = self.join(self.head, date_created, fields)
+        if match:
+            before, after = name[: match.start()], name[match.end() :]
+
+        if self.tail is None:
+            if match:
+                new_name = before + head + after
+                prefix, suffix = before + head + "_", after
+            elif head in name:
+                return filepath
+            else:
+                new_name = f"{head}_{name}"
+                prefix, suffix = head + "_", "_" + name
+            if new_name == name or new_name not in names:
+                return filepath.with_name(new_name)
+        else:
+            tail = self.join(self.tail, date_created, fields)
+            if name.startswith(head):
+                # the name was already given by the template, whatever the counter
+                rest = name[len(head) :]
+                digits = len(rest) - len(rest.lstrip("0123456789"))
+                if digits >= 3 and rest[digits:].startswith(tail):
+                    return filepath
+            if match:
+                prefix, suffix = before + head, tail + after
+            else:
+                prefix, suffix = head, f"{tail}_{name}"
+
+        for i in itertools.count():
+            new_name = f"{prefix}{i:03d}{suffix}"
+            if new_name == name or new_name not in names:
+                return filepath.with_name(new_name)
 
 
-def date_to_string(date, date_format):
-    """converts a date to string. sample output: 20210620_141545333"""
-    result = date.strftime(date_format)
-    if date_format == DEFAULT_DATE_FORMAT:
-        result = result[:-3]
-    return result
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(pattern, date_format):
+    """returns the RenameTemplate of the given pattern and date format, once"""
+    return RenameTemplate(pattern, date_format)
 
 
-def parse_jpeg_date(date_str):
-    """converts string to date"""
-    try:
-        return datetime.datetime.fromisoformat(date_str.replace(":", "-", 2))
-    except ValueError as e:
-        logger.debug(e)
-    return None
+@timed("generate_new_filename")
+def generate_new_filename(filepath, pattern, date_created, date_format, names=None):
+    """
+    returns a new path according to what the new filename should be
+    this functions tries to keep file descriptions in place
+    example:
+    - IMG_9398_picture_at_beach.JPG could become 20210820_123055000_picture_at_beach.JPG
+    names: names of the entries in the directory of the file, see list_names()
+           used to avoid collisions. the directory is listed if not given
+    see RenameTemplate for the placeholders of the date format
+    """
+    if names is None:
+        names = list_names(filepath.parent)
+    return compile_template(pattern, date_format).render(filepath, date_created, names)
 
 
-def parse_mov_date(date_str):
-    """converts string to date"""
+async def rename_tree(
+    paths,
+    recursive=False,
+    pattern=DEFAULT_PATTERN_NAME_TO_REPLACE,
+    date_format=DEFAULT_DATE_FORMAT,
+    dry_run=False,
+    cache=None,
+    renamed=None,
+    metadata_cache=None,
+    exclude=None,
+    max_depth=None,
+    max_inflight=DEFAULT_MAX_INFLIGHT,
+    incremental=None,
+):
+    """
+    asyncio alternative to process_path() for high latency filesystems such as
+    network mounts. listing directories, parsing files and renaming them overlap,
+    with at most max_inflight blocking operations running at once in threads.
+    the files of a directory are renamed one at a time in the order they were
+    listed, so the result is the same as process_path()
+    the caches and incremental are only accessed from the thread running the event loop
+    a file that can't be read or parsed is logged and left alone, so it doesn't
+    stop the other files, as in a long running service
+    returns the renamed dictionary { old_path: new_path }
+    """
+    import asyncio
+    import concurrent.futures
+
+    if renamed is None:
+        renamed = {}
+    if cache is None and not dry_run:
+        raise ValueError("a RevertCache is required unless dry_run is set")
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight)
+    # bounds the directories held in memory at once, their files are parsed together
+    directories = asyncio.Semaphore(max_inflight)
+    unreadable = set()  # files that failed to be read, retried by later runs
+
+    async def run(function, *args):
+        return await loop.run_in_executor(executor, function, *args)
+
+    async def get_date(filepath):
+        logger.debug("processing file: %s", filepath)
+        STATS.count("files")
+        try:
+            if metadata_cache is None:
+                return await run(get_original_date, filepath)
+            stat = await run(os.stat, filepath)
+            hit, date_created = metadata_cache.get(stat)
+            if not hit:
+                date_created = await run(get_original_date, filepath)
+                if is_cacheable(filepath, date_created):
+                    metadata_cache.set(stat, date_created)
+            return date_created
+        except Exception as e:  # a file failing doesn't stop the others
+            logger.error("unable to parse '%s': %s", filepath, e)
+            unreadable.add(filepath)
+            return None
+
+    async def rename_files_async(files, dates, names):
+        plan = plan_renames(list(zip(files, dates)), pattern, date_format, names)
+        steps = record_renames(plan, dry_run, cache, renamed, names)
+        if not steps:
+            return []
+        failures = await run(execute_renames, steps, names)
+        settle_renames(steps, failures, plan, cache, renamed)
+        return failures
+
+    async def process_directory_async(directory, relative, depth, group):
+        async with directories:
+            descend = recursive and (max_depth is None or depth < max_depth)
+            try:
+                stat = await run(os.stat, directory) if incremental else None
+                names, files, subdirectories = await run(
+                    scan_directory, directory, relative, descend, exclude
+                )
+            except OSError as e:
+                logger.error(e)
+                return
+            if incremental:
+                files = incremental.select(directory, stat, names, files)
+            for subdirectory, subdirectory_relative in subdirectories:
+                group.create_task(
+                    process_directory_async(
+                        subdirectory, subdirectory_relative, depth + 1, group
+                    )
+                )
+            if not files:
+                return
+            dates = await asyncio.gather(*(get_date(child) for child in files))
+            failures = await rename_files_async(files, dates, names)
+            if (
+                incremental
+                and not dry_run
+                and is_complete(zip(files, dates), failures)
+                and unreadable.isdisjoint(files)
+            ):
+                try:
+                    stat = await run(os.stat, directory)
+                except OSError as e:
+                    logger.error(e)
+                    return
+                incremental.mark(directory, names, stat)
+
+    async def process_file_async(filepath):
+        if filepath.suffix.lower() not in SUPPORTED_SUFFIXES:
+            return
+        try:
+            names = await run(list_names, filepath.parent)
+        except OSError as e:
+            logger.error(e)
+            return
+        await rename_files_async([filepath], [await get_date(filepath)], names)
+
     try:
-        return datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S%z")
-    except (TypeError, ValueError):
-        pass
-    return None
+        async with asyncio.TaskGroup() as group:
+            for path in paths:
+                if await run(path.is_dir):
+                    group.create_task(process_directory_async(path, "", 0, group))
+                else:
+                    group.create_task(process_file_async(path))
+    finally:
+        executor.shutdown()
+    return renamed
 
 
-def parse_mp4_date(date_str, coordinates, duration):
+def apply_plan(fp, dry_run, cache, renamed):
     """
-    duration: used to subtract from the date to find out the beginning of the video
-    coordinates: used to findout the timezone and apply the timezone to the date
+    renames files according to a plan written by PlanWriter, without parsing them
+    a rename is skipped if the file is missing, if it would move the file to
+    another directory or if its new name is taken by a file that isn't renamed
     """
-    try:
-        result = datetime.datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S %Z")
-        if duration:
-            result = result - datetime.timedelta(milliseconds=duration)
-        if coordinates:
-            # https://stackoverflow.com/questions/3518504/regular-expression-for-matching-latitude-longitude-coordinates#comment127711918_18690202
-            m = re.match(
-                r"(?P<lat>^[-+]?(?:[1-8]?\d(?:\.\d+)?|90(?:\.0+)?))(?P<lng>[-+]?(?:180(?:\.0+)?|(?:1[0-7]\d|[1-9]?\d)(?:\.\d+)?))/?$",
-                coordinates,
-            )
-            if m:
-                tf = TimezoneFinder()
-                longitude = float(m.group("lng"))
-                latitude = float(m.group("lat"))
-                tz = tf.timezone_at(lng=longitude, lat=latitude)
-                if tz:
-                    tz = ZoneInfo(tz)
-                    result = result.astimezone(tz)
-                    result = tz.fromutc(result)
-                    return result
-    except (TypeError, ValueError):
-        pass
-    return None
+    for directory, plan in read_plan(fp):
+        try:
+            names = list_names(directory)
+        except OSError as e:
+            logger.error(e)
+            continue
+        moving = {
+            filepath
+            for filepath, new_path in plan.items()
+            if filepath.name in names and new_path.parent == directory
+        }
+        taken = names.difference(filepath.name for filepath in moving)
+        valid = {}
+        for filepath, new_path in plan.items():
+            if filepath not in moving or new_path.name in taken:
+                logger.error("unable to rename %s to %s", filepath, new_path)
+                continue
+            valid[filepath] = new_path
+            taken.add(new_path.name)
+        apply_renames(valid, dry_run, cache, renamed, names)
 
 
-def get_original_date_jpeg(filepath):
+class InotifyWatcher:
     """
-    returns the DateTimeOriginal/DateTimeDigitized exif data from the given jpeg file
+    reports the files written to or moved into the watched directories using
+    inotify(7). directories created in them are watched as well if recursive
+    raises OSError if inotify isn't available, see PollingWatcher
     """
-    try:
-        with Image.open(filepath) as image:
-            # NOTE: using old "private" method because new public method
-            #       doesn't include this tag. It does include 306 "DateTime"
-            #       though, but "DateTime" might differ from "DateTimeOriginal"
-            # pylint: disable-next=protected-access
-            date_created = image._getexif().get(TAG_DATETIME_ORIGINAL)
-            if not date_created:
-                date_created = image._getexif().get(TAG_DATETIME_DIGITIZED)
-            if date_created:
-                # pylint: disable-next=protected-access
-                date_created += "." + image._getexif().get(
-                    TAG_SUBSECTIME_ORIGINAL, ""
-                ).zfill(3)
-    except (UnidentifiedImageError, AttributeError):
-        logger.debug("unable to parse '%s'", filepath)
-        return None
 
-    if date_created:
-        date_created = parse_jpeg_date(date_created)
+    def __init__(self, paths, recursive, exclude=None):
+        import ctypes
+        import ctypes.util
 
-    return date_created
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify isn't supported: {e}") from e
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.recursive = recursive
+        self.exclude = exclude
+        self.directories = {}  # { watch descriptor: directory }
+        for path in paths:
+            for directory, _, _ in walk_directories(path, recursive, exclude):
+                self.add_watch(directory)
 
+    def add_watch(self, directory):
+        """watches the directory"""
+        import ctypes
 
-def get_original_date_heif(filepath):
-    """returns the DateTimeOriginal exif data from the given heif file"""
-    date_created = None
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            logger.error("unable to watch %s: %s", directory, os.strerror(errno))
+            return
+        self.directories[wd] = directory
 
-    try:
-        image = pyheif.read(filepath)
-    except pyheif.error.HeifError:
-        logger.debug("unable to parse '%s'", filepath)
-        return None
+    def read(self, timeout):
+        """returns the paths of the files written or moved in within the timeout"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, INOTIFY_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("events were lost, listing the watched directories")
+                for directory in list(self.directories.values()):
+                    paths.extend(self.scan(directory, recursive=False))
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / os.fsdecode(name)
+            if not mask & IN_ISDIR:
+                if not mask & IN_CREATE:
+                    paths.append(path)
+            elif self.recursive and not (
+                self.exclude and self.exclude.match(path.name)
+            ):
+                # files may have been added before the directory was watched
+                paths.extend(self.scan(path, recursive=True))
+        return paths
 
-    for data in image.metadata or []:
-        if data["type"] == "Exif":
-            exif = piexif.load(data["data"])
-            date_created = (
-                exif.get("Exif", {}).get(TAG_DATETIME_ORIGINAL, b"").decode("utf-8")
-            )
-            if date_created:
-                date_created += "." + exif.get("Exif", {}).get(
-                    TAG_SUBSECTIME_ORIGINAL, b""
-                ).decode("utf-8").zfill(3)
-            break
+    def scan(self, directory, recursive):
+        """watches the new directories, returns the files already in them"""
+        files = []
+        for subdirectory, _, subdirectory_files in walk_directories(
+            directory, recursive, self.exclude
+        ):
+            if subdirectory not in self.directories.values():
+                self.add_watch(subdirectory)
+            files.extend(subdirectory_files)
+        return files
 
-    if date_created:
-        date_created = parse_jpeg_date(date_created)
+    def close(self):
+        """stops watching"""
+        os.close(self.fd)
 
-    return date_created
 
+class PollingWatcher:
+    """
+    reports the files added to or modified in the watched directories by listing
+    them every interval seconds. for filesystems without inotify, such as network
+    mounts whose changes are made by other hosts
+    """
 
-def get_original_date_mov(filepath):
-    """returns the creation time data from the given mov file"""
-    general_track = pymediainfo.MediaInfo.parse(filepath).general_tracks[0]
-    date_created = parse_mov_date(general_track.comapplequicktimecreationdate)
-    return date_created
+    def __init__(self, paths, recursive, exclude=None, interval=DEFAULT_POLL_INTERVAL):
+        self.paths = paths
+        self.recursive = recursive
+        self.exclude = exclude
+        self.interval = interval
+        self.snapshot = self.scan()
+        self.next_scan = time.monotonic() + interval
 
+    def scan(self):
+        """returns { filepath: (size, mtime_ns) } of the files of the directories"""
+        snapshot = {}
+        for path in self.paths:
+            for _, _, files in walk_directories(path, self.recursive, self.exclude):
+                for filepath in files:
+                    signature = get_file_signature(filepath)
+                    if signature:
+                        snapshot[filepath] = signature
+        return snapshot
 
-def get_original_date_mp4(filepath):
-    """returns the creation time data from the given mp4 file"""
-    general_track = pymediainfo.MediaInfo.parse(filepath).general_tracks[0]
-    date_created = parse_mp4_date(
-        general_track.encoded_date, general_track.xyz, general_track.duration
-    )
-    return date_created
+    def read(self, timeout):
+        """returns the paths of the files added or modified within the timeout"""
+        delay = self.next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(delay, 0))
+        self.next_scan = time.monotonic() + self.interval
+        snapshot = self.scan()
+        paths = [
+            filepath
+            for filepath, signature in snapshot.items()
+            if self.snapshot.get(filepath) != signature
+        ]
+        self.snapshot = snapshot
+        return paths
 
+    def close(self):
+        """stops watching"""
 
-def process_path(filepath, recursive, pattern, date_format, dry_run, cache, renamed):
-    """process the given image file or directory containing images"""
-    if filepath.is_dir():
-        process_directory(
-            filepath, recursive, pattern, date_format, dry_run, cache, renamed
-        )
-    else:
-        process_file(filepath, pattern, date_format, dry_run, cache, renamed)
 
+def get_file_signature(filepath):
+    """returns (size, mtime_ns) of the file, None if it's missing"""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
 
-def process_directory(
-    filepath, recursive, pattern, date_format, dry_run, cache, renamed
-):
-    """iterates over entries in the directory renaming files if needed"""
-    for child in filepath.iterdir():
-        if child.is_file():
-            process_file(child, pattern, date_format, dry_run, cache, renamed)
-        elif recursive and child.is_dir():
-            process_directory(
-                child, recursive, pattern, date_format, dry_run, cache, renamed
-            )
 
+def open_watcher(paths, recursive, exclude=None, poll_interval=None):
+    """
+    starts watching the given directories, see watch(). files written from then
+    on are reported, even while the directories are being processed
+    inotify is used unless a poll_interval is given or inotify isn't available,
+    in which case the directories are listed every poll_interval seconds
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(paths, recursive, exclude)
+        except OSError as e:
+            logger.warning("polling the directories, inotify isn't available: %s", e)
+            poll_interval = DEFAULT_POLL_INTERVAL
+    return PollingWatcher(paths, recursive, exclude, poll_interval)
 
-def process_file(filepath, pattern, date_format, dry_run, cache, renamed):
-    """parses the date created from the file and renames it if needed"""
-    logger.debug("processing file: %s", filepath)
-    suffix = filepath.suffix.lower()
-    if suffix in (".jpg", ".jpeg"):
-        date_created = get_original_date_jpeg(filepath)
-    elif suffix == ".heic":
-        date_created = get_original_date_heif(filepath)
-    elif suffix == ".mov":
-        date_created = get_original_date_mov(filepath)
-    elif suffix == ".mp4":
-        date_created = get_original_date_mp4(filepath)
-    else:
-        return
 
-    if not date_created:
-        logger.warning("unable to find date of creation for: %s", filepath)
-        return
+def watch(
+    paths,
+    recursive,
+    pattern,
+    date_format,
+    dry_run,
+    cache,
+    renamed=None,
+    metadata_cache=None,
+    exclude=None,
+    settle=DEFAULT_WATCH_SETTLE,
+    poll_interval=None,
+    stop=None,
+    watcher=None,
+    produced=(),
+):
+    """
+    watches the given directories, renaming the files written to them
+    a file is renamed once its size and modification time didn't change for
+    settle seconds, so files still being written aren't parsed. the files ready
+    at once are renamed in batches per directory, see rename_files(). a batch
+    failing is logged, the watch goes on
+    renamed: optional dictionary or PlanWriter filled with the renames
+    stop: threading.Event stopping the watch once set, runs forever otherwise
+    watcher: watcher started beforehand, see open_watcher(). it's left open
+             once the watch stops. opened with poll_interval if not given
+    produced: new paths of the files renamed since the watcher was started, such
+              as by a first pass over the directories. their events are ignored
+    """
+    opened = watcher is None
+    if opened:
+        watcher = open_watcher(paths, recursive, exclude, poll_interval)
+    logger.info("watching %s", ", ".join(str(path) for path in paths))
 
-    new_path = generate_new_filename(filepath, pattern, date_created, date_format)
-    if filepath != new_path and not new_path.is_file():
-        logger.info("renaming %s to %s", filepath, new_path)
-        renamed[filepath] = new_path
-        if not dry_run:
-            # cache: { directory: { new_path: old_path } }
-            if str(filepath.parent) not in cache:
-                cache[str(filepath.parent)] = {}
-            cache[str(filepath.parent)][str(new_path)] = str(filepath)
-            try:
-                filepath.rename(new_path)
-            except PermissionError as e:
-                logger.error(e)
+    pending = {}  # { filepath: (signature, deadline) }
+    produced = set(produced)  # files renamed by the watch, their events are ignored
+    try:
+        while stop is None or not stop.is_set():
+            timeout = WATCH_TIMEOUT
+            if pending:
+                deadline = min(deadline for _, deadline in pending.values())
+                timeout = min(max(deadline - time.monotonic(), 0), WATCH_TIMEOUT)
+            for filepath in watcher.read(timeout):
+                if filepath in produced:
+                    produced.discard(filepath)
+                    continue
+                if filepath.suffix.lower() not in SUPPORTED_SUFFIXES or (
+                    exclude and exclude.match(filepath.name)
+                ):
+                    continue
+                signature = get_file_signature(filepath)
+                if signature:
+                    pending[filepath] = (signature, time.monotonic() + settle)
 
+            ready = {}
+            now = time.monotonic()
+            for filepath, (signature, deadline) in list(pending.items()):
+                if deadline > now:
+                    continue
+                current = get_file_signature(filepath)
+                if current == signature:
+                    ready.setdefault(filepath.parent, []).append(filepath)
+                    del pending[filepath]
+                elif current:
+                    # still being written
+                    pending[filepath] = (current, now + settle)
+                else:
+                    del pending[filepath]
 
-def generate_new_filename(filepath, pattern, date_created, date_format):
+            for directory, files in ready.items():
+                try:
+                    names = list_names(directory)
+                except OSError as e:
+                    logger.error(e)
+                    continue
+                batch = {}
+                try:
+                    rename_files(
+                        list(iter_dates(sorted(files), metadata_cache=metadata_cache)),
+                        pattern,
+                        date_format,
+                        dry_run,
+                        cache,
+                        batch,
+                        names,
+                    )
+                except Exception as e:  # a file failing doesn't stop the watch
+                    logger.error("unable to rename the files of %s: %s", directory, e)
+                for filepath, new_path in batch.items():
+                    if renamed is not None:
+                        renamed[filepath] = new_path
+                    if not dry_run:
+                        produced.add(new_path)
+            if ready and metadata_cache is not None:
+                metadata_cache.commit()
+    finally:
+        if opened:
+            watcher.close()
+
+
+def revert_path(filepath, recursive, dry_run, cache, threads=DEFAULT_REVERT_THREADS):
     """
-    returns a new path according to what the new filename should be
-    this functions tries to keep file descriptions in place
-    example:
-    - IMG_9398_picture_at_beach.JPG could become 20210820_123055000_picture_at_beach.JPG
+    reverts changes for a directory or file
+    returns the renames that couldn't be reverted [(filepath, old_path)]
     """
-    date_time = date_to_string(date_created, date_format)
-    new_name = re.sub(pattern, date_time, filepath.name, count=1)
-    if date_time not in new_name:
-        new_name = f"{date_time}_{new_name}"
-    new_path = pathlib.Path(filepath.parent, new_name)
-    if filepath != new_path:
-        if new_path.is_file():
-            for i in range(10):
-                new_name = re.sub(
-                    pattern,
-                    f"{date_time}_00{i}",
-                    filepath.name,
-                    count=1,
-                )
-                if date_time not in new_name:
-                    new_name = f"{date_time}_00{i}_{new_name}"
-                new_path = pathlib.Path(new_path.parent, new_name)
-                if filepath == new_path or not new_path.is_file():
-                    break
-    return new_path
+    if filepath.is_dir():
+        return revert_directory(filepath, recursive, dry_run, cache, threads)
+    return revert_file(filepath, dry_run, cache)
 
 
-def revert_path(filepath, recursive, dry_run, cache):
-    """reverts changes for a directory or file"""
-    if filepath.is_dir():
-        revert_directory(filepath, recursive, dry_run, cache)
-    else:
-        revert_file(filepath, dry_run, cache)
+def revert_directory(
+    filepath, recursive, dry_run, cache, threads=DEFAULT_REVERT_THREADS
+):
+    """
+    reverts the renames recorded for files in the directory, and in its
+    subdirectories if recursive. only the directories found in the revert cache
+    are listed, so the time taken depends on the number of renames rather than
+    the size of the tree. directories are reverted by parallel threads, the
+    revert cache is only accessed from the calling thread
+    returns the renames that couldn't be reverted [(filepath, old_path)]
+    """
+    import concurrent.futures
+
+    directories = cache.get_directories(filepath, recursive)
+    failures = []
+    if not directories:
+        return failures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = executor.map(
+            revert_listed_directory,
+            directories.keys(),
+            directories.values(),
+            itertools.repeat(dry_run),
+        )
+        for reverted, not_reverted in results:
+            for path in reverted:
+                cache.remove(path)
+            failures.extend(not_reverted)
+    return failures
 
 
-def revert_directory(filepath, recursive, dry_run, cache):
-    """iterates over the directory, reverting renames that were made to it"""
-    for child in filepath.iterdir():
-        if child.is_file():
-            revert_file(child, dry_run, cache.get(str(child.parent), {}))
-        elif recursive and child.is_dir():
-            revert_directory(child, recursive, dry_run, cache)
-    if str(filepath) in cache and not cache.get(str(filepath)):
-        del cache[str(filepath)]
+def revert_listed_directory(directory, plan, dry_run):
+    """
+    lists the directory and reverts its renames { filepath: old_path }
+    the revert cache isn't accessed, so it can run in any thread
+    returns (reverted, failures), see revert_renames()
+    """
+    try:
+        names = list_names(directory)
+    except OSError as e:
+        logger.error(e)
+        return [], list(plan.items())
+    return revert_renames(plan, dry_run, names)
 
 
 def revert_file(filepath, dry_run, cache):
-    """reverts the rename of the file if it was found in the cache"""
-    old_path = cache.get(str(filepath))
-    if old_path:
-        old_path = pathlib.Path(old_path)
-        if not old_path.is_file():
-            logger.info("renaming %s to %s", filepath, old_path)
-            if not dry_run:
-                filepath.rename(old_path)
-                del cache[str(filepath)]
+    """
+    reverts the rename of the file if it was found in the cache
+    returns the renames that couldn't be reverted [(filepath, old_path)]
+    """
+    old_path = cache.get(filepath)
+    if not old_path:
+        return []
+    plan = {filepath: old_path}
+    reverted, failures = revert_renames(plan, dry_run, list_names(filepath.parent))
+    for path in reverted:
+        cache.remove(path)
+    return failures
+
+
+def revert_renames(plan, dry_run, names):
+    """
+    reverts the renames { filepath: old_path } of a directory
+    a file isn't reverted if it's missing or its old name was taken by a file not
+    being reverted. the renames are ordered like the original ones, see order_renames()
+    returns (reverted, failures), the files reverted and the renames
+    [(filepath, old_path)] that couldn't be
+    """
+    taken = names.difference(filepath.name for filepath in plan)
+    failures = []
+    revertible = {}
+    for filepath, old_path in plan.items():
+        if filepath.name not in names:
+            logger.error("unable to revert %s, the file is missing", filepath)
+        elif old_path.name in taken:
+            logger.error("unable to revert %s, %s exists", filepath, old_path)
+        else:
+            revertible[filepath] = old_path
+            continue
+        failures.append((filepath, old_path))
+    for filepath, old_path in revertible.items():
+        logger.info("renaming %s to %s", filepath, old_path)
+    if dry_run or not revertible:
+        return [], failures
+    steps = order_renames(revertible, names)
+    failed = {filepath for filepath, _, _ in execute_renames(steps, names)}
+    failures.extend(
+        (filepath, old_path)
+        for filepath, old_path in revertible.items()
+        if filepath in failed
+    )
+    return [filepath for filepath in revertible if filepath not in failed], failures
 
 
 def main():
@@ -299,6 +3141,20 @@ def main():
         action="store_true",
         help="recursively searches the given directory",
     )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        help="number of levels of subdirectories to recurse into, unlimited by default",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="""skips files and directories matching the given glob pattern. see fnmatch
+    the pattern is matched against the name and the path relative to the given directory
+    can be given multiple times. example: --exclude '*.AAE' --exclude '.thumbnails'""",
+    )
     parser.add_argument(
         "-p",
         "--pattern",
@@ -323,13 +3179,139 @@ def main():
           NOTE that this is the default setting. Also note that even though %%f is microsecond, we convert it to millisecond
         $ rename_images.py --date-format '%%Y-%%m-%%d_%%H-%%M-%%S' renames example.jpg to 2020-02-22_12-30-45_example.jpg
         $ rename_images.py --date-format '%%Y_%%m_%%d'          renames example.jpg to 2020_02_22_example.jpg
+    the format may hold placeholders, see RenameTemplate:
+        {camera} camera model, {orig} portion of the name matched by --pattern, {seq} counter starting at 000
+        $ rename_images.py --date-format '%%Y%%m%%d_{camera}_{seq}' renames IMG_0001.jpg to 20200222_Pixel 6_000.jpg
+    files sharing a name are told apart by a counter after the date: 20200222_123045000_001.jpg
 """,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="""number of worker processes used to parse the dates of creation
+    the files are still renamed one at a time, yielding the same result as a serial run""",
+    )
+    parser.add_argument(
+        "--max-read-bytes",
+        type=int,
+        metavar="BYTES",
+        help="""bytes the native parsers may read from each file, unlimited by default
+    files needing more aren't renamed. the libraries used for malformed files aren't used either""",
+    )
+    parser.add_argument(
+        "--drop-page-cache",
+        action="store_true",
+        help="drops the files parsed from the page cache, to scan archives without evicting other data",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=("native", "exiftool"),
+        default="native",
+        help="""parses the files with the native extractors, or with exiftool which reads more formats
+    a single exiftool process is kept running and given the files in batches. can't be combined with --jobs""",
+    )
+    parser.add_argument(
+        "--exiftool-command",
+        default=EXIFTOOL_COMMAND,
+        metavar="COMMAND",
+        help="command starting exiftool, or a compatible program, for --engine exiftool",
+    )
+    parser.add_argument(
+        "--exiftool-batch-size",
+        default=DEFAULT_EXIFTOOL_BATCH_SIZE,
+        type=int,
+        metavar="FILES",
+        help="files sent to exiftool at a time. larger batches are faster, smaller ones rename the first files sooner",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        help="""renames using asyncio with at most the given number of file operations in flight
+    faster on network mounts where each operation waits on the network. can't be combined with --jobs
+    with --revert, the number of directories reverted at once""",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""skips the work done by previous runs, for archives that mostly get new files
+    files whose name starts with a date in the --date-format aren't parsed, and directories
+    that didn't change since they were last processed are skipped. requires the metadata cache""",
+    )
+    parser.add_argument(
+        "--no-metadata-cache",
+        action="store_false",
+        dest="metadata_cache",
+        help="""don't use the cache of dates of creation parsed on previous runs
+    files that didn't change since then are otherwise not parsed again""",
+    )
+    parser.add_argument(
+        "--timezone-precision",
+        default=DEFAULT_TIMEZONE_PRECISION,
+        type=int,
+        help="""decimal places the coordinates of videos are rounded to when looking up their timezone
+    videos taken at the same rounded coordinates share a single lookup""",
+    )
+    parser.add_argument(
+        "--timezone-in-memory",
+        action="store_true",
+        help="loads the timezone data into memory, faster when processing many videos",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="""keeps running after processing the given directories, renaming the files written to them
+    uses inotify, or lists the directories periodically where it isn't available. see --poll""",
+    )
+    parser.add_argument(
+        "--settle",
+        default=DEFAULT_WATCH_SETTLE,
+        type=float,
+        metavar="SECONDS",
+        help="time a file must stay unchanged before --watch renames it, so files being written are left alone",
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        metavar="SECONDS",
+        help="makes --watch list the directories every given number of seconds instead of using inotify",
+    )
     parser.add_argument(
         "--revert",
         action="store_true",
         help="reverts changes for the given directory or file",
     )
+    parser.add_argument(
+        "--plan-out",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="""writes the renames to the given file as they are planned, one line of json per rename
+    combined with --dry-run, the plan can be reviewed and applied later on with --apply-plan""",
+    )
+    parser.add_argument(
+        "--apply-plan",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="renames the files according to a plan written by --plan-out, without parsing them again",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="prints the number of calls, total and p50/p95/p99 durations of each stage of the run",
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="writes the stats of the run to the given file as json, see --stats",
+    )
+    parser.add_argument(
+        "--profile",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="profiles the run with cProfile, writing the results to the given file. see pstats",
+    )
     parser.add_argument(
         "--debug",
         action="store_const",
@@ -363,8 +3345,9 @@ def main():
 
     if (
         len(args.date_format) < 4
-        or len(args.date_format) > 32
+        or len(args.date_format) > 64
         or "%" not in args.date_format
+        or args.date_format.count("{seq}") > 1
         or not LEGAL_DATE_FORMAT_CHARS.fullmatch(args.date_format)
     ):
         logger.error(
@@ -372,36 +3355,191 @@ def main():
         )
         sys.exit(1)
 
+    if args.jobs < 1:
+        logger.error("'%s' is not a valid number of jobs", args.jobs)
+        sys.exit(1)
+
+    if args.max_inflight is not None and (args.max_inflight < 1 or args.jobs > 1):
+        logger.error("--max-inflight must be positive and can't be used with --jobs")
+        sys.exit(1)
+
+    if args.apply_plan and (args.revert or not args.apply_plan.is_file()):
+        logger.error(
+            "'%s' is not a valid plan or was used with --revert", args.apply_plan
+        )
+        sys.exit(1)
+
+    if args.watch and (
+        args.revert
+        or args.apply_plan
+        or not all(path.is_dir() for path in args.path)
+        or args.settle < 0
+        or (args.poll is not None and args.poll <= 0)
+    ):
+        logger.error(
+            "--watch requires directories and can't be used with --revert or --apply-plan"
+        )
+        sys.exit(1)
+
+    if args.incremental and not args.metadata_cache:
+        logger.error("--incremental can't be used with --no-metadata-cache")
+        sys.exit(1)
+
+    if args.engine == "exiftool" and (args.jobs > 1 or args.exiftool_batch_size < 1):
+        logger.error(
+            "--engine exiftool needs a positive batch size and can't be used with --jobs"
+        )
+        sys.exit(1)
+
+    if args.max_read_bytes is not None and args.max_read_bytes < 1:
+        logger.error("'%s' is not a valid number of bytes", args.max_read_bytes)
+        sys.exit(1)
+
+    if args.max_depth is not None and args.max_depth < 0:
+        logger.error("'%s' is not a valid maximum depth", args.max_depth)
+        sys.exit(1)
+
     # read cache
     # TODO: maybe use appdirs to find cache_dir: https://github.com/ActiveState/appdirs
     cache_dir = os.environ.get("XDG_CACHE_DIR", pathlib.Path.home().joinpath(".cache"))
-    cached_data_file = pathlib.Path(cache_dir).joinpath(CACHE_FILENAME)
-    cached_data = {}
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cached_data = RevertCache(cache_dir.joinpath(CACHE_FILENAME))
+    cached_data.import_json(cache_dir.joinpath(LEGACY_CACHE_FILENAME))
     renamed_files = {}
-    try:
-        cached_data = json.loads(cached_data_file.read_text(encoding="utf-8"))
-    except (FileNotFoundError, json.decoder.JSONDecodeError):
-        pass
+    plan_out = None
+    produced = set() if args.watch else None  # renamed by the first pass, see watch()
+    if args.plan_out:
+        plan_out = open(args.plan_out, "w", encoding="utf-8")
+        renamed_files = PlanWriter(plan_out, produced)
+
+    metadata_cache = None
+    if args.metadata_cache and not args.revert and not args.apply_plan:
+        metadata_cache = MetadataCache(cache_dir.joinpath(METADATA_CACHE_FILENAME))
+
+    load_extractor_plugins()
+    configure_media_reader(args.max_read_bytes, args.drop_page_cache)
+    if args.engine == "exiftool":
+        import shlex
+
+        configure_exiftool(shlex.split(args.exiftool_command), args.exiftool_batch_size)
+    exclude = compile_exclude_patterns(args.exclude)
+    incremental = None
+    if args.incremental and metadata_cache:
+        incremental = Incremental(
+            metadata_cache, args.pattern, args.date_format, exclude
+        )
+    configure_timezone_lookup(args.timezone_precision, args.timezone_in_memory)
+
+    STATS.enabled = args.stats or args.stats_json is not None
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
 
     # make it so
-    for path in args.path:
+    watcher = None
+    try:
+        if args.watch:
+            # files written while the directories are processed are renamed too
+            watcher = open_watcher(args.path, args.recursive, exclude, args.poll)
         if args.revert:
-            revert_path(path, args.recursive, args.dry_run, cached_data)
-        else:
-            process_path(
-                path,
-                args.recursive,
-                args.pattern,
-                args.date_format,
-                args.dry_run,
-                cached_data,
-                renamed_files,
+            failures = []
+            for path in args.path:
+                failures += revert_path(
+                    path,
+                    args.recursive,
+                    args.dry_run,
+                    cached_data,
+                    args.max_inflight or DEFAULT_REVERT_THREADS,
+                )
+            if failures:
+                logger.warning("%d renames couldn't be reverted", len(failures))
+        elif args.apply_plan:
+            with open(args.apply_plan, encoding="utf-8") as fp:
+                try:
+                    apply_plan(fp, args.dry_run, cached_data, renamed_files)
+                except ValueError as error:
+                    logger.error(error)
+                    sys.exit(1)
+        elif args.max_inflight:
+            import asyncio
+
+            asyncio.run(
+                rename_tree(
+                    args.path,
+                    args.recursive,
+                    args.pattern,
+                    args.date_format,
+                    args.dry_run,
+                    cached_data,
+                    renamed_files,
+                    metadata_cache,
+                    exclude,
+                    args.max_depth,
+                    args.max_inflight,
+                    incremental,
+                )
             )
+        else:
+            for path in args.path:
+                process_path(
+                    path,
+                    args.recursive,
+                    args.pattern,
+                    args.date_format,
+                    args.dry_run,
+                    cached_data,
+                    renamed_files,
+                    args.jobs,
+                    metadata_cache,
+                    exclude,
+                    args.max_depth,
+                    incremental,
+                )
+        if args.watch:
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            try:
+                watch(
+                    args.path,
+                    args.recursive,
+                    args.pattern,
+                    args.date_format,
+                    args.dry_run,
+                    cached_data,
+                    renamed_files if args.plan_out else None,
+                    metadata_cache,
+                    exclude,
+                    args.settle,
+                    args.poll,
+                    stop,
+                    watcher,
+                    produced if args.plan_out else renamed_files.values(),
+                )
+            except KeyboardInterrupt:
+                pass
+    finally:
+        if watcher:
+            watcher.close()
+        configure_exiftool(None)
+        cached_data.close()
+        if metadata_cache:
+            metadata_cache.close()
+        if plan_out:
+            plan_out.close()
 
-    # update cache
-    cached_data_file.write_text(
-        json.dumps(cached_data, indent=2) + "\n", encoding="utf-8"
-    )
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if STATS.enabled:
+        report = STATS.report(time.perf_counter() - start)
+        if args.stats:
+            sys.stderr.write(format_stats(report))
+        if args.stats_json:
+            args.stats_json.write_text(
+                json.dumps(report, indent=2) + "\n", encoding="utf-8"
+            )
 
     return renamed_files
 
@@ -1,6 +1,19 @@
+import asyncio
+import datetime
+import importlib.metadata
+import io
+import json
 import pathlib
 import re
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
 import rename_images
+from rename_images import bench
+import piexif
 import pytest
 
 IMAGES_PATH = pathlib.Path(__file__).parent / "images"
@@ -13,6 +26,35 @@ def test_help_text_appears(monkeypatch, capsys):
     assert "usage: rename-images" in capsys.readouterr().out
 
 
+# imported on first use, see test_startup_imports()
+SLOW_IMPORTS = ("PIL", "piexif", "pyheif", "pymediainfo", "timezonefinder", "asyncio")
+
+
+def test_startup_imports():
+    # parsing a jpeg with the native parser and printing the help only need the
+    # standard library, python -X importtime lists every module imported
+    script = (
+        "import sys, rename_images;"
+        f"rename_images.get_original_date_jpeg(rename_images.pathlib.Path({str(IMAGES_PATH / 'jpg/Canon_40D.jpg')!r}));"
+        "sys.argv = ['rename-images', '--help'];"
+        "rename_images.main()"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    assert "usage: rename-images" in result.stdout
+    imported = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    assert "rename_images.rename_images" in imported
+    assert not {name.split(".")[0] for name in imported}.intersection(SLOW_IMPORTS)
+
+
 @pytest.mark.parametrize(
     "file_before, filename_pattern, date_format, recursive, expected_files_after",
     [
@@ -153,4 +195,1281 @@ def test_rename_image(
     assert renamed_files == expected_files_after
 
 
-# TODO: add tests for revert - single file, directory of files, recursion
+def test_rename_image_jobs_matches_serial_run():
+    serial = {}
+    parallel = {}
+    for renamed_files, jobs in ((serial, 1), (parallel, 2)):
+        rename_images.process_path(
+            IMAGES_PATH,
+            True,  # recursive
+            rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+            rename_images.DEFAULT_DATE_FORMAT,
+            True,  # dry_run
+            {},
+            renamed_files,
+            jobs,
+        )
+    assert parallel == serial
+    assert list(parallel) == list(serial)
+
+
+@pytest.mark.parametrize("filepath", sorted(IMAGES_PATH.rglob("*.jpg")), ids=str)
+def test_jpeg_exif_reader_matches_pillow(filepath):
+    with open(filepath, "rb") as fp:
+        date_created = rename_images.read_jpeg_exif_date(fp)
+    assert date_created == rename_images.read_pillow_exif_date(filepath)
+
+
+def test_jpeg_exif_reader_falls_back_on_malformed_file(tmp_path):
+    filepath = tmp_path / "broken.jpg"
+    filepath.write_bytes(b"\xff\xd8\xff\xe1\x00")
+    assert rename_images.get_original_date_jpeg(filepath) is None
+
+
+def make_exif_ifd(*entries):
+    """
+    returns a little endian exif TIFF structure whose exif IFD holds the given
+    (tag, type, value) entries, bypassing the types piexif enforces
+    """
+    ifd0 = struct.pack("<HHHII", 1, 34665, 4, 1, 26) + bytes(4)
+    data_offset = 26 + 2 + len(entries) * 12 + 4
+    ifd, data = struct.pack("<H", len(entries)), b""
+    for tag, kind, value in entries:
+        if len(value) > 4:
+            ifd += struct.pack("<HHII", tag, kind, len(value), data_offset + len(data))
+            data += value
+        else:
+            ifd += struct.pack(
+                "<HHI4s", tag, kind, len(value) if kind == 2 else 1, value
+            )
+    return b"II*\x00" + struct.pack("<I", 8) + ifd0 + ifd + bytes(4) + data
+
+
+@pytest.mark.parametrize(
+    "entries, expected",
+    [
+        # SubSecTimeOriginal stored as LONG is ignored
+        (
+            [(36867, 2, b"2022:02:26 20:22:13\x00"), (37521, 4, struct.pack("<I", 5))],
+            datetime.datetime(2022, 2, 26, 20, 22, 13),
+        ),
+        # so is a DateTimeOriginal stored as LONG
+        ([(36867, 4, struct.pack("<I", 5))], None),
+    ],
+    ids=["long-subsec", "long-date"],
+)
+def test_exif_reader_ignores_mistyped_tags(tmp_path, entries, expected):
+    exif = rename_images.EXIF_HEADER + make_exif_ifd(*entries)
+    filepath = tmp_path / "IMG_0001.jpg"
+    filepath.write_bytes(
+        b"\xff\xd8\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif + b"\xff\xd9"
+    )
+    assert rename_images.get_original_date(filepath) == expected
+
+
+@pytest.mark.parametrize("filepath", sorted(IMAGES_PATH.rglob("*.heic")), ids=str)
+def test_heif_exif_reader_matches_pyheif(filepath):
+    with open(filepath, "rb") as fp:
+        date_created = rename_images.read_heif_exif_date(fp)
+    assert date_created == rename_images.read_pyheif_exif_date(filepath)
+
+
+def mp4_box(kind, payload=b"", version=None):
+    if version is not None:  # full box
+        payload = bytes([version, 0, 0, 0]) + payload
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def make_video(quicktime, moov_at_end):
+    creation_time = datetime.datetime(2022, 2, 26, 20, 22, 13) - rename_images.MP4_EPOCH
+    mvhd = mp4_box(
+        b"mvhd",
+        struct.pack(">IIII", int(creation_time.total_seconds()), 0, 600, 600 * 12)
+        + bytes(80),
+        version=0,
+    )
+    xyz = b"+37.7749-122.4194/"
+    udta = mp4_box(
+        b"udta", mp4_box(b"\xa9xyz", struct.pack(">HH", len(xyz), 0x15C7) + xyz)
+    )
+    key = rename_images.QUICKTIME_CREATIONDATE_KEY
+    keys = mp4_box(
+        b"keys",
+        struct.pack(">II4s", 1, 8 + len(key), b"mdta") + key,
+        version=0,
+    )
+    data = mp4_box(b"data", struct.pack(">II", 1, 0) + b"2022-02-26T12:22:13-0800")
+    ilst = mp4_box(b"ilst", mp4_box(struct.pack(">I", 1), data))
+    hdlr = mp4_box(b"hdlr", bytes(4) + b"mdta" + bytes(13), version=0)
+    meta = mp4_box(b"meta", hdlr + keys + ilst, version=None if quicktime else 0)
+    moov = mp4_box(b"moov", mvhd + udta + meta)
+    ftyp = mp4_box(b"ftyp", b"qt  \x00\x00\x00\x00qt  ")
+    mdat = mp4_box(b"mdat", bytes(4096))
+    return ftyp + (mdat + moov if moov_at_end else moov + mdat)
+
+
+@pytest.mark.parametrize("quicktime", [False, True], ids=["mp4", "mov"])
+@pytest.mark.parametrize("moov_at_end", [False, True], ids=["moov-first", "moov-last"])
+def test_mp4_metadata_reader(tmp_path, quicktime, moov_at_end):
+    filepath = tmp_path / ("video.mov" if quicktime else "video.mp4")
+    filepath.write_bytes(make_video(quicktime, moov_at_end))
+    with open(filepath, "rb") as fp:
+        metadata = rename_images.read_mp4_metadata(fp)
+    assert metadata == {
+        "encoded_date": "2022-02-26 20:22:13 UTC",
+        "xyz": "+37.7749-122.4194/",
+        "duration": 12000,
+        "comapplequicktimecreationdate": "2022-02-26T12:22:13-0800",
+    }
+    if quicktime:
+        pst = datetime.timezone(-datetime.timedelta(hours=8))
+        assert rename_images.get_original_date_mov(filepath) == datetime.datetime(
+            2022, 2, 26, 12, 22, 13, tzinfo=pst
+        )
+    else:
+        assert rename_images.get_original_date_mp4(
+            filepath
+        ) == rename_images.parse_mp4_date(
+            metadata["encoded_date"], metadata["xyz"], metadata["duration"]
+        )
+
+
+@pytest.mark.parametrize(
+    "mvhd",
+    [b"", b"\x01\x00\x00\x00" + b"\xff" * 28, b"\x00\x00\x00\x00\x00"],
+    ids=["empty", "overflow", "truncated"],
+)
+def test_mp4_metadata_reader_falls_back_on_malformed_file(tmp_path, mvhd):
+    filepath = tmp_path / "video.mp4"
+    filepath.write_bytes(
+        mp4_box(b"ftyp", b"isom" * 3) + mp4_box(b"moov", mp4_box(b"mvhd", mvhd))
+    )
+    with open(filepath, "rb") as fp, pytest.raises((ValueError, struct.error)):
+        rename_images.read_mp4_metadata(fp)
+    assert rename_images.get_original_date(filepath) is None
+
+
+def test_metadata_cache(tmp_path):
+    filepath = tmp_path / "IMG_0001.jpg"
+    filepath.write_bytes((IMAGES_PATH / "jpg/Canon_40D.jpg").read_bytes())
+    metadata_cache = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    assert metadata_cache.get(filepath.stat()) == (False, None)
+
+    date_created = rename_images.get_original_date(filepath)
+    metadata_cache.set(filepath.stat(), date_created)
+    assert metadata_cache.get(filepath.stat()) == (True, date_created)
+
+    # renaming keeps the inode, so the entry stays valid
+    filepath = filepath.rename(tmp_path / "20080530_155601000.jpg")
+    assert metadata_cache.get(filepath.stat()) == (True, date_created)
+
+    # modifying the file evicts the entry
+    with open(filepath, "ab") as fp:
+        fp.write(b"\x00")
+    assert metadata_cache.get(filepath.stat()) == (False, None)
+    metadata_cache.close()
+
+
+def test_metadata_cache_is_consulted_before_parsing(tmp_path, monkeypatch):
+    metadata_cache = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    expected = {}
+    for renamed_files in (expected, {}):
+        rename_images.process_path(
+            IMAGES_PATH / "jpg",
+            False,
+            rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+            rename_images.DEFAULT_DATE_FORMAT,
+            True,  # dry_run
+            {},
+            renamed_files,
+            metadata_cache=metadata_cache,
+        )
+        monkeypatch.setattr(rename_images.rename_images, "get_original_date", None)
+    assert renamed_files == expected
+    metadata_cache.close()
+
+
+def test_iter_dates_streams_with_metadata_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(rename_images.rename_images, "CACHE_COMMIT_INTERVAL", 1)
+    metadata_cache = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    listed = []
+
+    def files():
+        for filepath in sorted((IMAGES_PATH / "jpg").iterdir()):
+            listed.append(filepath)
+            yield filepath
+
+    dates = rename_images.iter_dates(files(), metadata_cache=metadata_cache)
+    filepath, date_created = next(dates)
+    # files are parsed as they are listed, and cached right away
+    assert listed == [filepath]
+    reader = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    assert reader.get(filepath.stat()) == (True, date_created)
+    reader.close()
+    metadata_cache.close()
+
+
+@pytest.mark.parametrize("recursive", [False, True])
+def test_revert(tmp_path, recursive):
+    images_path = shutil.copytree(IMAGES_PATH, tmp_path / "images")
+    files_before = sorted(images_path.rglob("*"))
+    cache = rename_images.RevertCache(tmp_path / "cache.sqlite3")
+    renamed_files = {}
+    rename_images.process_path(
+        images_path,
+        recursive,
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        False,  # dry_run
+        cache,
+        renamed_files,
+    )
+    assert renamed_files
+    assert all(new_path.is_file() for new_path in renamed_files.values())
+    cache.close()
+
+    cache = rename_images.RevertCache(tmp_path / "cache.sqlite3")
+    rename_images.revert_path(images_path, recursive, False, cache)
+    assert sorted(images_path.rglob("*")) == files_before
+    assert not cache.has_directory(images_path)
+    cache.close()
+
+
+def test_revert_reports_failures(tmp_path, monkeypatch):
+    images_path = shutil.copytree(IMAGES_PATH, tmp_path / "images")
+    images_path.joinpath("untouched", "nested").mkdir(parents=True)
+    cache = rename_images.RevertCache(tmp_path / "cache.sqlite3")
+    renamed_files = {}
+    rename_images.process_path(
+        images_path,
+        True,  # recursive
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        False,  # dry_run
+        cache,
+        renamed_files,
+    )
+    (missing, missing_new), (taken, taken_new) = list(renamed_files.items())[:2]
+    missing_new.unlink()
+    taken.write_bytes(b"")
+
+    listed = []
+    list_names = rename_images.list_names
+    monkeypatch.setattr(
+        rename_images.rename_images,
+        "list_names",
+        lambda directory: listed.append(directory) or list_names(directory),
+    )
+    failures = rename_images.revert_path(images_path, True, False, cache)
+    assert sorted(failures) == sorted([(missing_new, missing), (taken_new, taken)])
+    # only the directories with renames are listed
+    assert sorted(listed) == sorted({path.parent for path in renamed_files})
+    assert all(
+        old_path.is_file()
+        for old_path in renamed_files
+        if old_path not in (missing, taken)
+    )
+    assert cache.get(missing_new) == missing and cache.get(taken_new) == taken
+    cache.close()
+
+
+def test_revert_relative_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("sub").mkdir()
+    shutil.copy(IMAGES_PATH / "jpg/Canon_40D.jpg", "IMG_0001.jpg")
+    shutil.copy(IMAGES_PATH / "jpg/Kodak_CX7530.jpg", "sub/IMG_0002.jpg")
+    cache = rename_images.RevertCache(":memory:")
+    rename_images.process_path(
+        pathlib.Path("."),
+        True,  # recursive
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        False,  # dry_run
+        cache,
+        {},
+    )
+    # earlier versions recorded the paths as given
+    pathlib.Path("sub/legacy.jpg").touch()
+    cache.connection.execute(
+        "INSERT INTO renames VALUES ('sub', 'sub/legacy.jpg', 'sub/IMG_0003.jpg')"
+    )
+    assert rename_images.revert_path(pathlib.Path("."), True, False, cache) == []
+    assert sorted(str(path) for path in tmp_path.rglob("*.jpg")) == [
+        str(tmp_path / "IMG_0001.jpg"),
+        str(tmp_path / "sub/IMG_0002.jpg"),
+        str(tmp_path / "sub/IMG_0003.jpg"),
+    ]
+    assert not cache.has_directory(pathlib.Path("sub"))
+    cache.close()
+
+
+def test_revert_single_file(tmp_path):
+    filepath = tmp_path / "Canon_40D.jpg"
+    shutil.copy(IMAGES_PATH / "jpg/Canon_40D.jpg", filepath)
+    cache = rename_images.RevertCache(tmp_path / "cache.sqlite3")
+    renamed_files = {}
+    rename_images.process_path(
+        filepath,
+        False,
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        False,  # dry_run
+        cache,
+        renamed_files,
+    )
+    rename_images.revert_path(renamed_files[filepath], False, False, cache)
+    assert filepath.is_file()
+    cache.close()
+
+
+def test_revert_cache_imports_json(tmp_path):
+    legacy = tmp_path / rename_images.LEGACY_CACHE_FILENAME
+    legacy.write_text(
+        '{"/photos": {"/photos/20080530_155601000.jpg": "/photos/IMG_0001.jpg"}}'
+    )
+    cache = rename_images.RevertCache(tmp_path / rename_images.CACHE_FILENAME)
+    cache.import_json(legacy)
+    assert cache.get(pathlib.Path("/photos/20080530_155601000.jpg")) == pathlib.Path(
+        "/photos/IMG_0001.jpg"
+    )
+    assert not legacy.exists()
+    cache.close()
+
+
+@pytest.mark.parametrize("dry_run", [True, False])
+def test_rename_colliding_dates(tmp_path, dry_run):
+    for i in range(3):
+        shutil.copy(IMAGES_PATH / "jpg/Canon_40D.jpg", tmp_path / f"IMG_000{i}.jpg")
+    renamed_files = {}
+    rename_images.process_path(
+        tmp_path,
+        False,
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        dry_run,
+        rename_images.RevertCache(":memory:"),
+        renamed_files,
+    )
+    assert sorted(new_path.name for new_path in renamed_files.values()) == [
+        "20080530_155601000.jpg",
+        "20080530_155601000_000.jpg",
+        "20080530_155601000_001.jpg",
+    ]
+    if not dry_run:
+        assert sorted(tmp_path.iterdir()) == sorted(renamed_files.values())
+
+
+@pytest.mark.parametrize(
+    "exclude, max_depth, expected_files",
+    [
+        (None, None, 7),
+        (None, 0, 2),
+        (["heic"], None, 5),
+        (["jpg/*.jpg", "DSCN*"], None, 3),
+        (["*.heic"], 1, 5),
+    ],
+)
+def test_walk_directories_filters(exclude, max_depth, expected_files):
+    files = list(
+        rename_images.iter_files(
+            IMAGES_PATH,
+            True,  # recursive
+            exclude=rename_images.compile_exclude_patterns(exclude),
+            max_depth=max_depth,
+        )
+    )
+    assert len(files) == expected_files
+
+
+def test_timezone_lookups_are_cached():
+    rename_images.configure_timezone_lookup(precision=2)
+    assert rename_images.timezone_at(37.77493, -122.41942) == "America/Los_Angeles"
+    assert rename_images.timezone_at(37.77201, -122.41799) == "America/Los_Angeles"
+    assert rename_images.lookup_timezone.cache_info().hits == 1
+    assert rename_images.lookup_timezone.cache_info().misses == 1
+    rename_images.configure_timezone_lookup()
+
+
+def test_bench(tmp_path):
+    output = tmp_path / "bench.json"
+    results = bench.main(
+        ["--files", "24", "--directory", str(tmp_path), "-o", str(output)]
+    )
+    assert json.loads(output.read_text()) == results
+    assert results["corpus"]["files"] == 24
+    assert results["results"]["get_original_date_mov"]["count"] == 6
+    assert results["results"]["revert_path"]["count"] == 1
+    assert not (tmp_path / "corpus").exists()
+
+
+def test_stats(monkeypatch):
+    monkeypatch.setattr(rename_images.STATS, "enabled", True)
+    rename_images.STATS.clear()
+    rename_images.process_path(
+        IMAGES_PATH,
+        True,  # recursive
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        True,  # dry_run
+        {},
+        {},
+    )
+    report = rename_images.STATS.report(1.0)
+    rename_images.STATS.clear()
+    assert report["files"] == 7
+    assert report["counters"]["bytes_read"] > 0
+    assert report["stages"]["extract_jpeg"]["count"] == 5
+    assert report["stages"]["extract_heif"]["count"] == 2
+    assert report["stages"]["walk"]["count"] == 3
+    assert "extract_jpeg" in rename_images.format_stats(report)
+
+    # the counters are shared by the threads parsing the files
+    stats = rename_images.Stats()
+    stats.enabled = True
+
+    def count():
+        for _ in range(10000):
+            stats.count("bytes_read", 2)
+
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stats.counters["bytes_read"] == 8 * 10000 * 2
+
+
+def test_rename_tree_matches_process_path(tmp_path):
+    expected = {}
+    rename_images.process_path(
+        IMAGES_PATH,
+        True,  # recursive
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        True,  # dry_run
+        {},
+        expected,
+    )
+    renamed_files = asyncio.run(
+        rename_images.rename_tree([IMAGES_PATH], recursive=True, dry_run=True)
+    )
+    assert renamed_files == expected
+
+    images_path = shutil.copytree(IMAGES_PATH, tmp_path / "images")
+    cache = rename_images.RevertCache(":memory:")
+    renamed_files = asyncio.run(
+        rename_images.rename_tree(
+            [images_path, tmp_path / "missing.txt"],
+            recursive=True,
+            cache=cache,
+            max_inflight=4,
+        )
+    )
+    assert {
+        key.relative_to(images_path): value.relative_to(images_path)
+        for key, value in renamed_files.items()
+    } == {
+        key.relative_to(IMAGES_PATH): value.relative_to(IMAGES_PATH)
+        for key, value in expected.items()
+    }
+    assert all(new_path.is_file() for new_path in renamed_files.values())
+    assert cache.has_directory(images_path / "heic")
+
+
+def test_rename_tree_survives_unreadable_files(tmp_path, monkeypatch):
+    images_path = shutil.copytree(IMAGES_PATH, tmp_path / "images")
+    unreadable = images_path / "jpg/Canon_40D.jpg"
+    metadata_cache = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    cache = rename_images.RevertCache(":memory:")
+    incremental = rename_images.Incremental(
+        metadata_cache,
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+    )
+    get_original_date = rename_images.get_original_date
+
+    def get_date(filepath):
+        if filepath == unreadable:
+            raise PermissionError(13, "Permission denied", str(filepath))
+        return get_original_date(filepath)
+
+    def run():
+        return asyncio.run(
+            rename_images.rename_tree(
+                [images_path],
+                recursive=True,
+                cache=cache,
+                metadata_cache=metadata_cache,
+                incremental=incremental,
+            )
+        )
+
+    monkeypatch.setattr(rename_images.rename_images, "get_original_date", get_date)
+    renamed_files = run()
+    # the other files and directories are renamed
+    assert unreadable not in renamed_files
+    assert any(filepath.parent == unreadable.parent for filepath in renamed_files)
+    assert any(filepath.suffix == ".heic" for filepath in renamed_files)
+
+    # once readable, the file is parsed again by the next incremental run
+    monkeypatch.setattr(
+        rename_images.rename_images, "get_original_date", get_original_date
+    )
+    assert list(run()) == [unreadable]
+    metadata_cache.close()
+    cache.close()
+
+
+@pytest.mark.parametrize("swap", [False, True], ids=["chain", "cycle"])
+def test_rename_batch_releases_names(tmp_path, monkeypatch, swap):
+    canon = (IMAGES_PATH / "jpg/Canon_40D.jpg").read_bytes()
+    kodak = (IMAGES_PATH / "jpg/Kodak_CX7530.jpg").read_bytes()
+    # the kodak image holds the name the canon image should be renamed to
+    (tmp_path / "20080530_155601000.jpg").write_bytes(kodak)
+    canon_name = "20050813_094723345.jpg" if swap else "IMG_0001.jpg"
+    (tmp_path / canon_name).write_bytes(canon)
+    cache = rename_images.RevertCache(tmp_path / "cache.sqlite3")
+    renamed_files = {}
+    rename_images.process_path(
+        tmp_path,
+        False,
+        re.compile(rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE),
+        rename_images.DEFAULT_DATE_FORMAT,
+        False,  # dry_run
+        cache,
+        renamed_files,
+    )
+    assert renamed_files == {
+        tmp_path / "20080530_155601000.jpg": tmp_path / "20050813_094723345.jpg",
+        tmp_path / canon_name: tmp_path / "20080530_155601000.jpg",
+    }
+    assert (tmp_path / "20080530_155601000.jpg").read_bytes() == canon
+    assert (tmp_path / "20050813_094723345.jpg").read_bytes() == kodak
+    assert not any(path.name.endswith(".rename_images") for path in tmp_path.iterdir())
+
+    # nothing is committed to the revert cache for a directory already renamed
+    with monkeypatch.context() as m:
+        m.setattr(cache, "add_batch", None)
+        renamed_files = {}
+        rename_images.process_path(
+            tmp_path,
+            False,
+            re.compile(rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE),
+            rename_images.DEFAULT_DATE_FORMAT,
+            False,  # dry_run
+            cache,
+            renamed_files,
+        )
+        assert renamed_files == {}
+
+    rename_images.revert_path(tmp_path, False, False, cache)
+    assert (tmp_path / "20080530_155601000.jpg").read_bytes() == kodak
+    assert (tmp_path / canon_name).read_bytes() == canon
+    cache.close()
+
+
+def test_plan_out_and_apply_plan(tmp_path, monkeypatch):
+    images_path = shutil.copytree(IMAGES_PATH, tmp_path / "images")
+    expected = {}
+    rename_images.process_path(
+        images_path,
+        True,  # recursive
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        True,  # dry_run
+        {},
+        expected,
+    )
+    assert expected
+
+    plan_path = tmp_path / "plan.ndjson"
+    with open(plan_path, "w", encoding="utf-8") as fp:
+        writer = rename_images.PlanWriter(fp)
+        rename_images.process_path(
+            images_path,
+            True,  # recursive
+            rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+            rename_images.DEFAULT_DATE_FORMAT,
+            True,  # dry_run
+            {},
+            writer,
+        )
+        assert len(writer) == len(expected)
+    with open(plan_path, encoding="utf-8") as fp:
+        lines = [json.loads(line) for line in fp]
+    assert {pathlib.Path(line["old"]): pathlib.Path(line["new"]) for line in lines} == (
+        expected
+    )
+
+    # a reviewed plan may drop renames, retracted renames aren't applied either,
+    # even when the retraction follows the renames of other directories
+    skipped, retracted = list(expected)[:2]
+    with open(plan_path, "w", encoding="utf-8") as fp:
+        for line in lines:
+            if line["old"] != str(skipped):
+                fp.write(json.dumps(line) + "\n")
+        fp.write(json.dumps({"old": str(retracted), "new": None}) + "\n")
+    del expected[skipped], expected[retracted]
+
+    # the files aren't parsed again
+    monkeypatch.setattr(rename_images.rename_images, "get_original_date", None)
+    cache = rename_images.RevertCache(":memory:")
+    renamed_files = {}
+    with open(plan_path, encoding="utf-8") as fp:
+        rename_images.apply_plan(fp, False, cache, renamed_files)
+    assert renamed_files == expected
+    assert all(new_path.is_file() for new_path in expected.values())
+    assert skipped.is_file() and retracted.is_file()
+    assert cache.get(next(iter(expected.values()))) == next(iter(expected))
+
+    # applying the plan again fails without renaming anything
+    renamed_files = {}
+    with open(plan_path, encoding="utf-8") as fp:
+        rename_images.apply_plan(fp, False, cache, renamed_files)
+    assert renamed_files == {}
+
+    with pytest.raises(ValueError, match="line 1"):
+        rename_images.apply_plan(io.StringIO("not json\n"), False, cache, {})
+
+
+def test_rename_template(tmp_path):
+    date = datetime.datetime(2022, 2, 26, 20, 22, 13, 203000)
+    pattern = re.compile(rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE, re.IGNORECASE)
+    for date_format in ("%Y%m%d_%H%M%S%f", "%Y-%m-%d_%H-%M-%S", "%y%j_%a_%%"):
+        formatter = rename_images.compile_date_formatter(date_format)
+        assert formatter(date) == date.strftime(date_format)
+
+    # the counter isn't limited to 10 collisions
+    names = {"20220226_202213203_beach.jpg"}
+    names.update(f"20220226_202213203_{i:03d}_beach.jpg" for i in range(12))
+    new_path = rename_images.generate_new_filename(
+        tmp_path / "IMG_0001_beach.jpg",
+        pattern,
+        date,
+        rename_images.DEFAULT_DATE_FORMAT,
+        names,
+    )
+    assert new_path.name == "20220226_202213203_012_beach.jpg"
+
+    def generate(name, date_format, names=()):
+        return rename_images.generate_new_filename(
+            tmp_path / name, pattern, date, date_format, set(names)
+        ).name
+
+    assert generate("IMG_0001.jpg", "%Y%m%d_{seq}") == "20220226_000.jpg"
+    assert generate("IMG_0001.jpg", "%Y%m%d_{seq}", ["20220226_000.jpg"]) == (
+        "20220226_001.jpg"
+    )
+    # names given by the template are kept, whatever their counter
+    assert generate("20220226_005.jpg", "%Y%m%d_{seq}") == "20220226_005.jpg"
+    assert generate("IMG_0001_beach.jpg", "%Y%m%d_{orig}") == (
+        "20220226_IMG_0001_beach.jpg"
+    )
+    shutil.copy(IMAGES_PATH / "jpg/Canon_40D.jpg", tmp_path / "IMG_0002.jpg")
+    assert generate("IMG_0002.jpg", "%Y%m%d_{camera}") == "20220226_Canon EOS 40D.jpg"
+    assert rename_images.compile_date_format("%Y%m%d_{camera}_{seq}").match(
+        "20220226_Canon EOS 40D_003.jpg"
+    )
+    with pytest.raises(ValueError):
+        rename_images.RenameTemplate(pattern, "%Y{seq}{seq}")
+
+
+def test_compile_date_format():
+    date = datetime.datetime(2021, 6, 20, 14, 15, 45, 333000)
+    for date_format in (
+        rename_images.DEFAULT_DATE_FORMAT,
+        "%Y-%m-%d_%H-%M-%S",
+        "%d %b %Y",
+        "100%%_%Y",
+    ):
+        regex = rename_images.compile_date_format(date_format)
+        date_time = rename_images.date_to_string(date, date_format)
+        assert regex.match(f"{date_time}_001_beach.jpg"), date_format
+        assert not regex.match(f"IMG_1234_{date_time}.jpg"), date_format
+    assert not rename_images.compile_date_format("%Y%m%d").match("IMG_1234.jpg")
+
+
+@pytest.mark.parametrize("engine", ["process_path", "rename_tree"])
+def test_incremental(tmp_path, monkeypatch, engine):
+    images_path = shutil.copytree(IMAGES_PATH, tmp_path / "images")
+    metadata_cache = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    cache = rename_images.RevertCache(":memory:")
+    pattern = rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE
+    date_format = rename_images.DEFAULT_DATE_FORMAT
+    incremental = rename_images.Incremental(metadata_cache, pattern, date_format)
+    parsed = []
+    get_original_date = rename_images.get_original_date
+
+    def get_original_date_spy(filepath):
+        parsed.append(filepath)
+        return get_original_date(filepath)
+
+    monkeypatch.setattr(
+        rename_images.rename_images, "get_original_date", get_original_date_spy
+    )
+
+    def run():
+        parsed.clear()
+        if engine == "rename_tree":
+            return asyncio.run(
+                rename_images.rename_tree(
+                    [images_path],
+                    recursive=True,
+                    cache=cache,
+                    metadata_cache=metadata_cache,
+                    incremental=incremental,
+                )
+            )
+        renamed_files = {}
+        rename_images.process_path(
+            images_path,
+            True,  # recursive
+            pattern,
+            date_format,
+            False,  # dry_run
+            cache,
+            renamed_files,
+            metadata_cache=metadata_cache,
+            incremental=incremental,
+        )
+        return renamed_files
+
+    assert run()
+    assert parsed
+
+    # nothing changed, not even the files that couldn't be renamed are parsed again
+    assert run() == {}
+    assert parsed == []
+
+    # only the new file is parsed, the renamed files are recognized by their name
+    new_file = shutil.copy(
+        IMAGES_PATH / "jpg/Canon_40D.jpg", images_path / "jpg/new.jpg"
+    )
+    assert list(run()) == [new_file]
+    assert parsed == [new_file]
+    assert run() == {}
+
+    # a rename that failed is retried by the next run
+    failing = shutil.copy(
+        IMAGES_PATH / "jpg/Canon_40D.jpg", images_path / "jpg/failing.jpg"
+    )
+    rename = pathlib.Path.rename
+
+    def rename_failing(self, target):
+        if self == failing:
+            raise PermissionError(f"unable to rename {self}")
+        return rename(self, target)
+
+    monkeypatch.setattr(pathlib.Path, "rename", rename_failing)
+    assert run() == {}
+    monkeypatch.setattr(pathlib.Path, "rename", rename)
+    assert list(run()) == [failing]
+
+    # so are the files without a date that may have been cut short by the read budget
+    monkeypatch.setitem(rename_images.MEDIA_READER, "max_bytes", 1 << 20)
+    undated = images_path / "jpg/undated.jpg"
+    undated.write_bytes(b"garbage")
+    for _ in range(2):
+        assert run() == {}
+        assert parsed == [undated]
+
+    # watermarks are kept per settings
+    settings = rename_images.Incremental(metadata_cache, pattern, "%Y-%m-%d").settings
+    assert metadata_cache.get_watermark(images_path / "jpg", settings) is None
+    assert metadata_cache.get_watermark(images_path / "jpg", incremental.settings)
+    metadata_cache.close()
+    cache.close()
+
+
+@pytest.mark.parametrize("poll_interval", [None, 0.05], ids=["inotify", "polling"])
+def test_watch(tmp_path, poll_interval):
+    stop = threading.Event()
+    renamed_files = {}
+    errors = []
+
+    def run():
+        cache = rename_images.RevertCache(":memory:")
+        try:
+            rename_images.watch(
+                [tmp_path],
+                True,  # recursive
+                rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+                rename_images.DEFAULT_DATE_FORMAT,
+                False,  # dry_run
+                cache,
+                renamed_files,
+                settle=0.2,
+                poll_interval=poll_interval,
+                stop=stop,
+            )
+        except Exception as e:
+            errors.append(e)
+        finally:
+            cache.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        time.sleep(0.2)
+        (tmp_path / "album").mkdir()
+        contents = (IMAGES_PATH / "jpg/Canon_40D.jpg").read_bytes()
+        filepath = tmp_path / "album" / "IMG_0001.jpg"
+        # the file is written slowly, it's only renamed once it's complete
+        with open(filepath, "wb") as fp:
+            fp.write(contents[:100])
+            fp.flush()
+            time.sleep(0.1)
+            fp.write(contents[100:])
+        (tmp_path / "notes.txt").write_text("not an image")
+
+        new_path = tmp_path / "album" / "20080530_155601000.jpg"
+        deadline = time.monotonic() + 10
+        while not new_path.exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # the files renamed by the watch aren't picked up again
+        time.sleep(0.5)
+    finally:
+        stop.set()
+        thread.join()
+    assert not errors
+    assert renamed_files == {filepath: new_path}
+    assert new_path.read_bytes() == contents
+
+
+@pytest.mark.parametrize("poll_interval", [None, 0.05], ids=["inotify", "polling"])
+def test_watch_started_before_processing(tmp_path, monkeypatch, poll_interval):
+    watcher = rename_images.open_watcher([tmp_path], True, poll_interval=poll_interval)
+    # written while the directories were processed, before the watch runs
+    for name in ("unreadable", "album"):
+        (tmp_path / name).mkdir()
+        shutil.copy(IMAGES_PATH / "jpg/Canon_40D.jpg", tmp_path / name / "IMG_0001.jpg")
+    get_original_date = rename_images.get_original_date
+
+    def get_date(filepath):
+        if filepath.parent.name == "unreadable":
+            raise PermissionError(13, "Permission denied", str(filepath))
+        return get_original_date(filepath)
+
+    monkeypatch.setattr(rename_images.rename_images, "get_original_date", get_date)
+    stop = threading.Event()
+    renamed_files = {}
+    thread = threading.Thread(
+        target=rename_images.watch,
+        args=(
+            [tmp_path],
+            True,  # recursive
+            rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+            rename_images.DEFAULT_DATE_FORMAT,
+            True,  # dry_run
+            {},
+            renamed_files,
+        ),
+        kwargs={"settle": 0.1, "stop": stop, "watcher": watcher},
+    )
+    thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not renamed_files and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        thread.join()
+        watcher.close()
+    # the batch failing is logged, the other one is renamed
+    assert renamed_files == {
+        tmp_path / "album/IMG_0001.jpg": tmp_path / "album/20080530_155601000.jpg"
+    }
+
+
+@pytest.mark.parametrize("poll_interval", [None, 0.05], ids=["inotify", "polling"])
+def test_watch_ignores_first_pass_renames(tmp_path, monkeypatch, poll_interval):
+    images_path = shutil.copytree(IMAGES_PATH / "jpg", tmp_path / "images")
+    watcher = rename_images.open_watcher(
+        [images_path], True, poll_interval=poll_interval
+    )
+    cache = rename_images.RevertCache(":memory:")
+    first_pass = {}
+    rename_images.process_path(
+        images_path,
+        True,  # recursive
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        False,  # dry_run
+        cache,
+        first_pass,
+    )
+    assert first_pass
+    parsed = []
+    get_original_date = rename_images.get_original_date
+
+    def get_original_date_spy(filepath):
+        parsed.append(filepath)
+        return get_original_date(filepath)
+
+    monkeypatch.setattr(
+        rename_images.rename_images, "get_original_date", get_original_date_spy
+    )
+    stop = threading.Event()
+    renamed_files = {}
+    thread = threading.Thread(
+        target=rename_images.watch,
+        args=(
+            [images_path],
+            True,  # recursive
+            rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+            rename_images.DEFAULT_DATE_FORMAT,
+            False,  # dry_run
+            cache,
+            renamed_files,
+        ),
+        kwargs={
+            "settle": 0.1,
+            "stop": stop,
+            "watcher": watcher,
+            "produced": first_pass.values(),
+        },
+    )
+    thread.start()
+    try:
+        new_file = shutil.copy(
+            IMAGES_PATH / "jpg/Canon_40D.jpg", images_path / "IMG_9999.jpg"
+        )
+        deadline = time.monotonic() + 10
+        while not renamed_files and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        thread.join()
+        watcher.close()
+        cache.close()
+    # only the file written after the first pass is parsed
+    assert list(renamed_files) == [new_file]
+    assert parsed == [new_file]
+
+
+def make_exif(date=b"2022:02:26 20:22:13", subsec=b"203"):
+    """returns an exif TIFF structure with the given DateTimeOriginal"""
+    exif = piexif.dump({"Exif": {36867: date, 37521: subsec}})
+    return exif[len(rename_images.EXIF_HEADER) :]
+
+
+def png_chunk(kind, payload):
+    return struct.pack(">I4s", len(payload), kind) + payload + bytes(4)
+
+
+def riff_chunk(kind, payload):
+    return struct.pack("<4sI", kind, len(payload)) + payload + bytes(len(payload) & 1)
+
+
+def make_png(*chunks):
+    ihdr = png_chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0))
+    idat = png_chunk(b"IDAT", bytes(16))
+    return rename_images.PNG_SIGNATURE + ihdr + b"".join(chunks) + idat
+
+
+def make_webp(*chunks):
+    data = b"WEBP" + b"".join(chunks)
+    return b"RIFF" + struct.pack("<I", len(data)) + data
+
+
+@pytest.mark.parametrize(
+    "filename, contents, expected",
+    [
+        (
+            "IMG_0001.png",
+            make_png(png_chunk(b"eXIf", make_exif())),
+            datetime.datetime(2022, 2, 26, 20, 22, 13, 203000),
+        ),
+        (
+            "IMG_0002.png",
+            make_png(
+                png_chunk(b"tEXt", b"Comment\x00hello"),
+                png_chunk(b"tEXt", b"Creation Time\x002021-06-20T14:15:45"),
+            ),
+            datetime.datetime(2021, 6, 20, 14, 15, 45),
+        ),
+        (
+            "IMG_0003.png",
+            make_png(png_chunk(b"tEXt", b"Creation Time\x00Sun, 20 Jun 2021 14:15:45")),
+            datetime.datetime(2021, 6, 20, 14, 15, 45),
+        ),
+        ("IMG_0004.png", make_png(), None),
+        (
+            "IMG_0005.webp",
+            make_webp(
+                riff_chunk(b"VP8X", bytes([rename_images.WEBP_VP8X_EXIF]) + bytes(9)),
+                riff_chunk(b"VP8 ", bytes(33)),
+                riff_chunk(b"EXIF", rename_images.EXIF_HEADER + make_exif()),
+            ),
+            datetime.datetime(2022, 2, 26, 20, 22, 13, 203000),
+        ),
+        ("IMG_0006.webp", make_webp(riff_chunk(b"VP8 ", bytes(33))), None),
+        (
+            "IMG_0007.cr2",
+            make_exif() + bytes(1024),
+            datetime.datetime(2022, 2, 26, 20, 22, 13, 203000),
+        ),
+        (
+            "IMG_0008.dng",
+            make_exif(subsec=b"") + bytes(1024),
+            datetime.datetime(2022, 2, 26, 20, 22, 13),
+        ),
+    ],
+)
+def test_header_extractors(tmp_path, filename, contents, expected):
+    filepath = tmp_path / filename
+    filepath.write_bytes(contents)
+    assert rename_images.get_original_date(filepath) == expected
+    # the data following the header isn't read
+    filepath.write_bytes(contents + b"\x00" * 4096)
+    assert rename_images.get_original_date(filepath) == expected
+
+
+def test_extractors_sniff_contents(tmp_path):
+    filepath = tmp_path / "IMG_0001.jpg"
+    shutil.copy(IMAGES_PATH / "heic/example.heic", filepath)
+    assert rename_images.sniff_extractor(filepath).name == "heif"
+    assert rename_images.get_original_date(filepath) == (
+        rename_images.get_original_date_heif(IMAGES_PATH / "heic/example.heic")
+    )
+    # unrecognized contents fall back to the suffix
+    filepath.write_bytes(b"garbage")
+    assert rename_images.sniff_extractor(filepath) is None
+    assert rename_images.get_original_date(filepath) is None
+
+    for filepath, name in (
+        (IMAGES_PATH / "jpg/Canon_40D.jpg", "jpeg"),
+        (IMAGES_PATH / "heic/sample1.heic", "heif"),
+    ):
+        assert rename_images.sniff_extractor(filepath).name == name
+    for quicktime, name in ((True, "mov"), (False, "mp4")):
+        filepath = tmp_path / "video.bin"
+        filepath.write_bytes(bench.make_video(quicktime))
+        assert rename_images.sniff_extractor(filepath).name == name
+    # other ISO base media files aren't parsed as mp4
+    for brand in (b"avif", b"crx ", b"3gp4", b"M4A "):
+        filepath.write_bytes(b"\x00\x00\x00\x14ftyp" + brand + bytes(8))
+        assert rename_images.sniff_extractor(filepath) is None
+
+
+def test_files_opened_once(monkeypatch):
+    module = rename_images.rename_images
+    opened = []
+
+    class MediaReader(module.MediaReader):
+        def __init__(self, filepath, *args, **kwargs):
+            opened.append(filepath)
+            super().__init__(filepath, *args, **kwargs)
+
+    monkeypatch.setattr(module, "MediaReader", MediaReader)
+    filepath = IMAGES_PATH / "jpg/Canon_40D.jpg"
+    assert rename_images.get_original_date(filepath)
+    assert opened == [filepath]
+    assert rename_images.get_camera_model(filepath) == "Canon EOS 40D"
+    assert opened == [filepath, filepath]
+
+
+def test_extractor_plugins(tmp_path, monkeypatch):
+    module = rename_images.rename_images
+    monkeypatch.setattr(module, "EXTRACTORS", dict(module.EXTRACTORS))
+    monkeypatch.setattr(
+        module, "EXTRACTORS_BY_SUFFIX", dict(module.EXTRACTORS_BY_SUFFIX)
+    )
+    monkeypatch.setattr(module, "SUPPORTED_SUFFIXES", set(module.SUPPORTED_SUFFIXES))
+
+    def get_original_date_txt(filepath):
+        return datetime.datetime.fromisoformat(filepath.read_text().split(":", 1)[1])
+
+    def setup(register_extractor):
+        register_extractor(
+            "txt",
+            get_original_date_txt,
+            (".txt",),
+            lambda header: header.startswith(b"taken:"),
+        )
+
+    class EntryPoint:
+        name = "txt"
+
+        def load(self):
+            return setup
+
+    class BrokenEntryPoint:
+        name = "broken"
+
+        def load(self):
+            raise ImportError("missing dependency")
+
+    def entry_points(group):
+        assert group == rename_images.EXTRACTORS_ENTRY_POINT_GROUP
+        return [BrokenEntryPoint(), EntryPoint()]
+
+    monkeypatch.setattr(importlib.metadata, "entry_points", entry_points)
+    module.load_extractor_plugins.cache_clear()
+    try:
+        module.load_extractor_plugins()
+    finally:
+        module.load_extractor_plugins.cache_clear()
+
+    (tmp_path / "IMG_0001.txt").write_text("taken:2021-06-20 14:15:45")
+    renamed_files = {}
+    rename_images.process_path(
+        tmp_path,
+        False,  # recursive
+        rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+        rename_images.DEFAULT_DATE_FORMAT,
+        True,  # dry_run
+        {},
+        renamed_files,
+    )
+    assert renamed_files == {
+        tmp_path / "IMG_0001.txt": tmp_path / "20210620_141545000.txt"
+    }
+
+
+# stand-in for exiftool -stay_open True -@ -, the files hold the tags it reports
+FAKE_EXIFTOOL = """
+import json, os, sys
+
+args = []
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if args and args[-1] == "-stay_open" and line == "False":
+        break
+    if not line.startswith("-execute"):
+        args.append(line)
+        continue
+    entries = []
+    for arg in args:
+        if arg.startswith("-") or not os.path.isfile(arg):
+            continue
+        with open(arg) as fp:
+            tags = json.load(fp)
+        if tags.pop("crash", False) and not os.path.exists(arg + ".crashed"):
+            open(arg + ".crashed", "w").close()
+            sys.exit(1)
+        entries.append({"SourceFile": arg, **tags})
+    if entries:
+        print(json.dumps(entries, indent=4))
+    print("{ready" + line[len("-execute"):] + "}", flush=True)
+    args = []
+"""
+
+
+def test_failed_files_are_not_cached(tmp_path, monkeypatch):
+    filepath = tmp_path / "IMG_0001.jpg"
+    shutil.copy(IMAGES_PATH / "jpg/Canon_40D.jpg", filepath)
+
+    class FailingBackend:
+        failed = {filepath}
+
+        def get_dates(self, files):
+            return [None] * len(files)
+
+    monkeypatch.setitem(
+        rename_images.rename_images.ENGINE, "exiftool", FailingBackend()
+    )
+    metadata_cache = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    asyncio.run(
+        rename_images.rename_tree(
+            [tmp_path], dry_run=True, metadata_cache=metadata_cache, max_inflight=2
+        )
+    )
+    assert metadata_cache.get(filepath.stat()) == (False, None)
+    metadata_cache.close()
+
+
+def test_exiftool_engine(tmp_path, monkeypatch):
+    module = rename_images.rename_images
+    monkeypatch.setattr(module, "SUPPORTED_SUFFIXES", set(module.SUPPORTED_SUFFIXES))
+    script = tmp_path / "exiftool.py"
+    script.write_text(FAKE_EXIFTOOL)
+    images_path = tmp_path / "images"
+    images_path.mkdir()
+    for name, tags in (
+        (
+            "IMG_0001.cr3",
+            {"DateTimeOriginal": "2022:02:26 20:22:13", "SubSecTimeOriginal": 5},
+        ),
+        ("IMG_0002.jpg", {"SubSecDateTimeOriginal": "2021:06:20 14:15:45.333+02:00"}),
+        (
+            "IMG_0003.mp4",
+            {
+                "CreateDate": "0000:00:00 00:00:00",
+                "CreationDate": "2020:01:02 03:04:05",
+            },
+        ),
+        ("IMG_0004.tif", {"crash": True, "DateTimeOriginal": "2019:01:01 00:00:00"}),
+        ("IMG_0005.avi", {}),
+    ):
+        (images_path / name).write_text(json.dumps(tags))
+
+    backend = rename_images.ExiftoolBackend([sys.executable, str(script)], batch_size=2)
+    monkeypatch.setitem(module.ENGINE, "exiftool", backend)
+    module.SUPPORTED_SUFFIXES.update(rename_images.EXIFTOOL_SUFFIXES)
+    renamed_files = {}
+    try:
+        rename_images.process_path(
+            images_path,
+            False,  # recursive
+            rename_images.DEFAULT_PATTERN_NAME_TO_REPLACE,
+            rename_images.DEFAULT_DATE_FORMAT,
+            True,  # dry_run
+            {},
+            renamed_files,
+        )
+        # the process crashed on the fourth file and was restarted
+        assert backend.process.poll() is None
+        assert rename_images.get_original_date(images_path / "IMG_0005.avi") is None
+    finally:
+        backend.close()
+    assert {key.name: value.name for key, value in renamed_files.items()} == {
+        "IMG_0001.cr3": "20220226_202213005.cr3",
+        "IMG_0002.jpg": "20210620_141545333.jpg",
+        "IMG_0003.mp4": "20200102_030405000.mp4",
+        "IMG_0004.tif": "20190101_000000000.tif",
+    }
+    assert backend.process is None
+
+
+def test_media_reader(tmp_path):
+    filepath = tmp_path / "file.bin"
+    filepath.write_bytes(bytes(range(256)) * 4)
+    with rename_images.MediaReader(filepath, max_bytes=24, window=8) as fp:
+        # the window is read at once
+        assert fp.read(4) == bytes([0, 1, 2, 3]) and fp.bytes_read == 8
+        assert isinstance(fp.view(2), memoryview) and fp.bytes_read == 8
+        assert fp.seek(-2, 2) == 1022
+        assert fp.view().tobytes() == bytes([254, 255])
+        assert fp.read(4) == b""
+        fp.seek(100)
+        # the rest of the budget is read as a block
+        assert fp.read(10) == bytes(range(100, 110))
+        assert fp.tell() == 110 and fp.bytes_read == 24
+        assert fp.read(2) == bytes([110, 111]) and fp.bytes_read == 24
+        with pytest.raises(rename_images.ReadBudgetExceeded):
+            fp.read(4)
+
+    filepath.write_bytes(b"")
+    with rename_images.MediaReader(filepath, drop_cache=True) as fp:
+        assert fp.read(8) == b""
+
+
+def test_read_budget(tmp_path, monkeypatch):
+    monkeypatch.setitem(rename_images.MEDIA_READER, "max_bytes", 2048)
+    # the media data of the video is skipped, only its boxes are read
+    filepath = tmp_path / "video.mp4"
+    filepath.write_bytes(bench.make_video(quicktime=False))
+    assert filepath.stat().st_size > 64 * 1024
+    assert rename_images.get_original_date(filepath)
+
+    monkeypatch.setitem(rename_images.MEDIA_READER, "max_bytes", 64)
+    filepath = IMAGES_PATH / "jpg/Canon_40D.jpg"
+    assert rename_images.get_original_date(filepath) is None
+    # the libraries used for malformed files can't be bounded
+    assert rename_images.read_pillow_exif_date(filepath) is None
+    # files the budget stopped aren't cached as having no date
+    metadata_cache = rename_images.MetadataCache(tmp_path / "metadata.sqlite3")
+    list(rename_images.iter_dates([filepath], metadata_cache=metadata_cache))
+    assert metadata_cache.get(filepath.stat()) == (False, None)
+    metadata_cache.close()